@@ -0,0 +1,49 @@
+"""
+Bulk catalog import from the command line.
+
+    python import_catalog.py products.csv
+    python import_catalog.py distributor.ndjson --chunk-size 1000
+
+Uses the same streaming parser and batched upserts as POST /api/admin/products/import,
+writing straight to the database configured by MONGO_URL / DB_NAME.
+"""
+import asyncio
+import json
+from pathlib import Path
+from typing import Optional
+
+import typer
+
+from server import client, import_products, IMPORT_CHUNK_SIZE
+
+app = typer.Typer(add_completion=False)
+
+
+async def _run(path: Path, fmt: str, chunk_size: int):
+    with open(path, "rb") as f:
+        async for update in import_products(f, fmt, chunk_size):
+            if update["done"]:
+                for err in update["errors"]:
+                    typer.echo(f"line {err['line']}: {err['error']}", err=True)
+                typer.echo(json.dumps({k: v for k, v in update.items() if k != "errors"}))
+                return update
+            typer.echo(f"processed {update['rows']} rows ({update['inserted']} new, {update['updated']} updated, {update['error_count']} errors)", err=True)
+
+
+@app.command()
+def main(
+    path: Path = typer.Argument(..., exists=True, dir_okay=False),
+    format: Optional[str] = typer.Option(None, help="csv or ndjson; inferred from the file extension if omitted"),
+    chunk_size: int = typer.Option(IMPORT_CHUNK_SIZE, help="Rows per validation/upsert batch"),
+):
+    fmt = format or ("csv" if path.suffix.lower() == ".csv" else "ndjson")
+    try:
+        result = asyncio.run(_run(path, fmt, chunk_size))
+    finally:
+        client.close()
+    if result and result["error_count"]:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,240 @@
+"""
+Replay a traffic capture (see CAPTURE_SAMPLE_RATE in server.py) against the FastAPI app
+in-process, with Square and the ZIP geocoder stubbed out, and report per-route latency.
+
+    MONGO_URL=mongodb://localhost:27017 DB_NAME=replay python replay_traffic.py capture.jsonl
+    python replay_traffic.py capture.jsonl --speed 4 --scale 3   # 4x faster, 3 copies of each request
+
+Point MONGO_URL/DB_NAME at a disposable local database: replayed orders and payments are real
+writes. Captured product ids are mapped onto the local catalog, and created order and ID
+upload ids are tracked so later checkout, payment and status calls hit the ones created
+during the replay. ID photos are never captured; uploads replay a placeholder JPEG of the
+captured size.
+"""
+import asyncio
+import io
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+
+import typer
+
+os.environ.setdefault("CAPTURE_SAMPLE_RATE", "0")
+import server  # noqa: E402  (env must be settled before the app module loads)
+
+app = typer.Typer(add_completion=False)
+
+# Replayed geocodes resolve to points a few miles from the origin, so quotes stay in-zone
+STUB_GEO = (server.ORIGIN_LAT + 0.05, server.ORIGIN_LON + 0.05, "TX")
+
+
+def install_stubs(square_latency: float, geocoder_latency: float):
+    def geocode_zip(zip_code):
+        time.sleep(geocoder_latency)
+        return STUB_GEO
+
+    def create_payment(**kwargs):
+        time.sleep(square_latency)
+        return SimpleNamespace(payment=SimpleNamespace(id=f"replay-{kwargs['idempotency_key'][:12]}"))
+
+    server.geocode_zip = geocode_zip
+    server.square_client.payments.create = create_payment
+    server.HEALTH_PROBES.pop("square", None)
+
+
+async def call_app(method, path, query="", body=b"", content_type="application/json"):
+    """Drive the ASGI app directly; returns (status, body_bytes, route_template)."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": query.encode(), "server": ("replay", 80), "client": ("127.0.0.1", 0),
+        "headers": [(b"host", b"replay"), (b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    }
+    sent = False
+    status, chunks = None, []
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            await asyncio.Event().wait()
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await server.app(scope, receive, send)
+    return status, b"".join(chunks), getattr(scope.get("route"), "path", None) or path
+
+
+def restore_images(value):
+    if isinstance(value, dict):
+        if "__image_bytes__" in value and len(value) == 1:
+            prefix = "data:image/jpeg;base64,"
+            return prefix + "A" * max(0, value["__image_bytes__"] - len(prefix))
+        return {k: restore_images(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [restore_images(v) for v in value]
+    return value
+
+
+_placeholder_jpeg = None
+
+
+def placeholder_upload(size):
+    """Multipart body of about `size` bytes carrying a decodable JPEG; returns (body, content_type)."""
+    global _placeholder_jpeg
+    if _placeholder_jpeg is None:
+        if server.Image is not None:
+            out = io.BytesIO()
+            server.Image.new("RGB", (640, 400), (128, 128, 128)).save(out, "JPEG")
+            _placeholder_jpeg = out.getvalue()
+        else:
+            _placeholder_jpeg = b"\xff\xd8\xff\xd9"  # without Pillow the server only sniffs the magic bytes
+    boundary = uuid.uuid4().hex
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"id.jpg\"\r\n"
+            f"Content-Type: image/jpeg\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    # Pad with JPEG comment segments (at most 65533 bytes each) right after the SOI marker
+    padding, missing = [], size - len(head) - len(tail) - len(_placeholder_jpeg)
+    while missing > 4:
+        n = min(missing - 4, 65533)
+        padding.append(b"\xff\xfe" + (n + 2).to_bytes(2, "big") + b"\0" * n)
+        missing -= n + 4
+    image = _placeholder_jpeg[:2] + b"".join(padding) + _placeholder_jpeg[2:]
+    return head + image + tail, f"multipart/form-data; boundary={boundary}"
+
+
+class Replayer:
+    def __init__(self, product_ids):
+        self.product_ids = product_ids
+        self.product_map = {}
+        self.order_map = {}
+        self.upload_map = {}
+        self.latencies = {}
+        self.errors = {}
+
+    def map_product(self, pid):
+        if not self.product_ids or pid in self.product_ids:
+            return pid
+        if pid not in self.product_map:
+            self.product_map[pid] = self.product_ids[len(self.product_map) % len(self.product_ids)]
+        return self.product_map[pid]
+
+    def rewrite(self, entry):
+        path, payload = entry["path"], restore_images(entry.get("json"))
+        parts = path.split("/")
+        if len(parts) >= 4 and parts[2] == "products" and parts[3] != "import":
+            parts[3] = self.map_product(parts[3])
+        for i, part in enumerate(parts):
+            parts[i] = self.order_map.get(part, part)
+        if isinstance(payload, dict):
+            for item in payload.get("items") or []:
+                if isinstance(item, dict) and "product_id" in item:
+                    item["product_id"] = self.map_product(item["product_id"])
+            if "order_id" in payload:
+                payload["order_id"] = self.order_map.get(payload["order_id"], payload["order_id"])
+            if payload.get("id_upload"):
+                payload["id_upload"] = self.upload_map.get(payload["id_upload"], payload["id_upload"])
+            for update in payload.get("updates") or []:
+                if isinstance(update, dict) and "order_id" in update:
+                    update["order_id"] = self.order_map.get(update["order_id"], update["order_id"])
+        return "/".join(parts), payload
+
+    async def send(self, entry):
+        path, payload = self.rewrite(entry)
+        content_type = entry.get("content_type") or "application/json"
+        if payload is None and entry.get("body_bytes") and content_type.startswith("multipart/"):
+            body, content_type = placeholder_upload(entry["body_bytes"])
+        else:
+            body = json.dumps(payload).encode() if payload is not None else b""
+        started = time.perf_counter()
+        status, resp, route = await call_app(entry["method"], path, entry.get("query", ""), body, content_type)
+        elapsed = (time.perf_counter() - started) * 1000
+        key = f"{entry['method']} {entry.get('route') or route}"
+        self.latencies.setdefault(key, []).append(elapsed)
+        if status is None or status >= 500 or (entry.get("status") and status // 100 != entry["status"] // 100):
+            self.errors[key] = self.errors.get(key, 0) + 1
+        for ref, field, mapping in (("order_ref", "order_id", self.order_map), ("upload_ref", "upload_id", self.upload_map)):
+            if entry.get(ref):
+                try:
+                    mapping[entry[ref]] = json.loads(resp)[field]
+                except (ValueError, KeyError, TypeError):
+                    pass
+
+    def report(self):
+        def pct(values, p):
+            return values[min(len(values) - 1, int(len(values) * p))]
+        rows = []
+        for key, values in sorted(self.latencies.items(), key=lambda kv: -len(kv[1])):
+            values.sort()
+            rows.append({
+                "route": key, "count": len(values), "errors": self.errors.get(key, 0),
+                "p50_ms": round(pct(values, 0.5), 2), "p95_ms": round(pct(values, 0.95), 2),
+                "p99_ms": round(pct(values, 0.99), 2), "max_ms": round(values[-1], 2),
+            })
+        return rows
+
+
+def load_capture(path: Path):
+    with open(path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda e: e["ts"])
+    return entries
+
+
+async def replay(entries, speed: float, scale: int):
+    await server.app.router.startup()
+    try:
+        status, body, _ = await call_app("GET", "/api/products")
+        product_ids = [p["id"] for p in json.loads(body)] if status == 200 else []
+        replayer = Replayer(product_ids)
+        if not entries:
+            return replayer
+        origin, wall = entries[0]["ts"], time.perf_counter()
+        pending = set()
+        for entry in entries:
+            delay = (entry["ts"] - origin) / speed - (time.perf_counter() - wall)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            for _ in range(scale):
+                task = asyncio.create_task(replayer.send(entry))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        return replayer
+    finally:
+        await server.app.router.shutdown()
+
+
+@app.command()
+def main(
+    capture: Path = typer.Argument(..., exists=True, dir_okay=False),
+    speed: float = typer.Option(1.0, help="Timing multiplier; 2 replays twice as fast"),
+    scale: int = typer.Option(1, help="Concurrent copies of each captured request"),
+    square_latency: float = typer.Option(0.3, help="Seconds the stubbed Square call takes"),
+    geocoder_latency: float = typer.Option(0.05, help="Seconds the stubbed geocoder takes"),
+    output: Path = typer.Option(None, help="Write the per-route report as JSON"),
+):
+    install_stubs(square_latency, geocoder_latency)
+    entries = load_capture(capture)
+    typer.echo(f"Replaying {len(entries)} requests x{scale} at {speed}x speed", err=True)
+    replayer = asyncio.run(replay(entries, speed, scale))
+    rows = replayer.report()
+    typer.echo(f"{'route':48} {'count':>6} {'err':>5} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for r in rows:
+        typer.echo(f"{r['route'][:48]:48} {r['count']:>6} {r['errors']:>5} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {r['max_ms']:>9}")
+    if output:
+        output.write_text(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    app()
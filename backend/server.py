@@ -1,28 +1,375 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Request, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartParser, MultiPartException
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument, WriteConcern, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 import os
 import logging
+import logging.handlers
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, TypeAdapter, ValidationError
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, date
 from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse, FileResponse
 import math
+import base64
+import bisect
+import heapq
+import gzip
+import hashlib
+import hmac
+import time
+import sys
+import atexit
+import threading
+import random
+import queue
+import tracemalloc
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextlib
+import contextvars
+from datetime import timedelta
 import json
+import csv
+import io
+import tempfile
+import mimetypes
 from urllib.request import urlopen
+from urllib.parse import parse_qsl, urlencode
 from square import Square
 from square.environment import SquareEnvironment
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ---- Request tracing ----
+# Each HTTP request gets a trace id (continued from an incoming W3C traceparent when one
+# is sent) that is returned in X-Trace-Id. Spans are collected in a contextvar for the
+# life of the request: Mongo commands via a pymongo CommandListener (Motor copies the
+# context onto its worker threads), plus trace_span() blocks around outbound calls.
+# A finished trace is kept for TRACE_SAMPLE_RATE of requests and always when it is slower
+# than TRACE_SLOW_MS or ends in a 5xx; kept traces are written as OTLP/JSON lines to
+# rotating files under TRACE_DIR by a background thread. Overflow is dropped, not queued.
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '1000'))
+TRACE_DIR = os.environ.get('TRACE_DIR', '/tmp/xplicit-traces')
+TRACE_FILE_MAX_BYTES = int(os.environ.get('TRACE_FILE_MAX_BYTES', str(50 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = int(os.environ.get('TRACE_FILE_BACKUPS', '5'))
+TRACE_MAX_SPANS = 1000
+SERVICE_NAME = os.environ.get('SERVICE_NAME', 'xplicit-backend')
+
+class Trace:
+    __slots__ = ("trace_id", "spans")
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.spans = []
+
+    def add(self, span):
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append(span)
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+def _new_span(trace, name, attributes, kind=1):
+    # kind follows OTLP SpanKind: 1 internal, 2 server, 3 client
+    return {
+        "traceId": trace.trace_id, "spanId": os.urandom(8).hex(), "parentSpanId": _current_span.get() or "",
+        "name": name, "kind": kind, "startTimeUnixNano": time.time_ns(), "endTimeUnixNano": None,
+        "attributes": attributes, "status": {"code": 0},
+    }
+
+def span_error(span, exc):
+    if span is not None:
+        span["status"] = {"code": 2, "message": str(exc)[:500]}
+        span["attributes"]["exception.type"] = type(exc).__name__
+
+@contextlib.contextmanager
+def trace_span(name, kind=1, **attributes):
+    """Time a block as a child of the current span; a no-op outside a traced request."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    span = _new_span(trace, name, attributes, kind)
+    token = _current_span.set(span["spanId"])
+    try:
+        yield span
+    except Exception as e:
+        span_error(span, e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span["endTimeUnixNano"] = time.time_ns()
+        trace.add(span)
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """One span per Mongo command (find, getMore, insert, ...) issued inside a traced request."""
+    def __init__(self):
+        self._open = {}
+
+    def started(self, event):
+        trace = _current_trace.get()
+        if trace is None:
+            return
+        target = event.command.get(event.command_name)
+        span = _new_span(trace, f"mongo.{event.command_name}", {
+            "db.system": "mongodb", "db.name": event.database_name, "db.operation": event.command_name,
+            "db.mongodb.collection": target if isinstance(target, str) else "",
+            "server.address": f"{event.connection_id[0]}:{event.connection_id[1]}",
+        }, kind=3)
+        self._open[(event.connection_id, event.request_id)] = (trace, span)
+
+    def _finish(self, event, error=None):
+        trace, span = self._open.pop((event.connection_id, event.request_id), (None, None))
+        if span is None:
+            return
+        span["endTimeUnixNano"] = span["startTimeUnixNano"] + event.duration_micros * 1000
+        if error:
+            span["status"] = {"code": 2, "message": str(error)[:500]}
+        trace.add(span)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event, event.failure.get("errmsg") or "command failed")
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": "" if value is None else str(value)}
+
+def _otlp_span(span):
+    out = dict(span)
+    out["startTimeUnixNano"] = str(span["startTimeUnixNano"])
+    out["endTimeUnixNano"] = str(span["endTimeUnixNano"] or span["startTimeUnixNano"])
+    out["attributes"] = [{"key": k, "value": _otlp_value(v)} for k, v in span["attributes"].items()]
+    return out
+
+class TraceExporter:
+    def __init__(self, directory, max_bytes, backups):
+        self.queue = queue.Queue(maxsize=2000)
+        self.exported = 0
+        self.dropped = 0
+        self._args = (directory, max_bytes, backups)
+        self._thread = None
+
+    def offer(self, spans):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer, name="trace-export", daemon=True)
+            self._thread.start()
+        try:
+            self.queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer(self):
+        directory, max_bytes, backups = self._args
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(Path(directory) / "traces.jsonl", maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        resource = {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]}
+        while True:
+            spans = self.queue.get()
+            line = json.dumps({"resourceSpans": [{"resource": resource, "scopeSpans": [{
+                "scope": {"name": "xplicit.server"}, "spans": [_otlp_span(s) for s in spans],
+            }]}]}, separators=(",", ":"))
+            handler.emit(logging.makeLogRecord({"msg": line, "levelno": logging.INFO}))
+            self.exported += 1
+
+trace_exporter = TraceExporter(TRACE_DIR, TRACE_FILE_MAX_BYTES, TRACE_FILE_BACKUPS) if TRACE_DIR else None
+
+def _incoming_trace_id(headers):
+    # traceparent: 00-<32 hex trace id>-<16 hex parent id>-<flags>
+    parts = headers.get(b"traceparent", b"").decode("latin-1").split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and parts[1] != "0" * 32:
+        try:
+            int(parts[1], 16)
+            return parts[1], parts[2]
+        except ValueError:
+            pass
+    return None, None
+
+class TracingMiddleware:
+    def __init__(self, app, exporter, sample_rate, slow_ms):
+        self.app = app
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trace_id, parent_id = _incoming_trace_id(dict(scope.get("headers") or []))
+        trace = Trace(trace_id or os.urandom(16).hex())
+        trace_token = _current_trace.set(trace)
+        parent_token = _current_span.set(parent_id)
+        status = 500
+
+        async def traced_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-trace-id", trace.trace_id.encode())]}
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            with trace_span(f"{scope['method']} {scope['path']}", kind=2, **{"http.method": scope["method"], "url.path": scope["path"]}) as root:
+                await self.app(scope, receive, traced_send)
+        finally:
+            _current_span.reset(parent_token)
+            _current_trace.reset(trace_token)
+            route = getattr(scope.get("route"), "path", None)
+            if route:
+                root["name"] = f"{scope['method']} {route}"
+                root["attributes"]["http.route"] = route
+            root["attributes"]["http.status_code"] = status
+            if status >= 500 and root["status"]["code"] == 0:
+                root["status"] = {"code": 2, "message": f"HTTP {status}"}
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if self.exporter and (status >= 500 or elapsed_ms >= self.slow_ms or random.random() < self.sample_rate):
+                self.exporter.offer(list(trace.spans))
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection checkout wait times and in-use counts, for sizing maxPoolSize.
+    Motor checks connections out on its worker threads, so the wait is timed per thread."""
+    def __init__(self, window=500):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.waits_ms = deque(maxlen=window)
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.connections_created = 0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def _waited(self):
+        started = getattr(self._local, "started", None)
+        return (time.perf_counter() - started) * 1000 if started else 0.0
+
+    def connection_checked_out(self, event):
+        waited = self._waited()
+        with self._lock:
+            self.waits_ms.append(waited)
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def connection_check_out_failed(self, event):
+        self._waited()
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+
+    def snapshot(self):
+        with self._lock:
+            waits = sorted(self.waits_ms)
+        pick = lambda p: round(waits[min(len(waits) - 1, int(len(waits) * p))], 3) if waits else None
+        return {
+            "max_pool_size": MONGO_CLIENT_OPTIONS["maxPoolSize"], "checked_out": self.checked_out,
+            "peak_checked_out": self.peak_checked_out, "checkouts": self.checkouts,
+            "checkout_failures": self.checkout_failures, "connections_created": self.connections_created,
+            "wait_p50_ms": pick(0.5), "wait_p95_ms": pick(0.95), "wait_max_ms": round(waits[-1], 3) if waits else None,
+        }
+
+# Client tuning; size maxPoolSize from /api/admin/db/pool under peak load
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.environ.get('MONGO_MAX_POOL_SIZE', '50')),
+    "minPoolSize": int(os.environ.get('MONGO_MIN_POOL_SIZE', '0')),
+    "maxIdleTimeMS": int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000')),
+    "waitQueueTimeoutMS": int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '2000')),
+    "serverSelectionTimeoutMS": int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+    "connectTimeoutMS": int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000')),
+    "compressors": os.environ.get('MONGO_COMPRESSORS', 'zstd,zlib' if zstandard else 'zlib'),
+    "appname": os.environ.get('MONGO_APP_NAME', 'xplicit-backend'),
+}
+# Server-side cap for request-path queries, matched to the client-side db_call deadlines
+DB_MAX_TIME_MS = int(os.environ.get('DB_MAX_TIME_MS', '2000'))
+
+pool_stats = PoolStats()
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[pool_stats, MongoCommandTracer()], **MONGO_CLIENT_OPTIONS)
 db = client[os.environ['DB_NAME']]
 
+def _parse_write_concern(spec):
+    """"w=majority,j=true,wtimeout=5000" -> WriteConcern"""
+    opts = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        key, _, value = part.partition("=")
+        if key == "w":
+            opts["w"] = int(value) if value.isdigit() else value
+        elif key == "j":
+            opts["j"] = value.lower() in ("1", "true", "yes")
+        elif key == "wtimeout":
+            opts["wtimeout"] = int(value)
+    return WriteConcern(**opts)
+
+# Named write profiles: cheap, loss-tolerant writes acknowledge on the primary only;
+# money and order state wait for a majority. Override with MONGO_WRITE_CONCERN_<NAME>.
+WRITE_PROFILES = {
+    name: _parse_write_concern(os.environ.get(f'MONGO_WRITE_CONCERN_{name.upper()}', default))
+    for name, default in (
+        ("analytics", "w=1"),
+        ("orders", "w=majority,wtimeout=5000"),
+        ("payment", "w=majority,j=true,wtimeout=10000"),
+    )
+}
+_writers = {}
+
+def writer(collection, profile):
+    key = (collection, profile)
+    if key not in _writers:
+        _writers[key] = db.get_collection(collection, write_concern=WRITE_PROFILES[profile])
+    return _writers[key]
+
 # Square configuration
 SQUARE_APP_ID = os.environ.get('SQUARE_APP_ID', '')
 SQUARE_ACCESS_TOKEN = os.environ.get('SQUARE_ACCESS_TOKEN', '')
@@ -60,6 +407,7 @@ class Product(BaseModel):
     size: Optional[str] = None
     image_url: Optional[str] = None
     coa_url: Optional[str] = None
+    sku: Optional[str] = None
     variants: Optional[list] = None  # List of variant options (e.g., strain choices)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -74,11 +422,24 @@ class ProductCreate(BaseModel):
     size: Optional[str] = None
     image_url: Optional[str] = None
     coa_url: Optional[str] = None
+    sku: Optional[str] = None
     variants: Optional[list] = None
 
 class CartItem(BaseModel):
     product_id: str
     quantity: int = 1
+    variant: Optional[str] = None
+
+class OrderLineItem(CartItem):
+    # Catalog snapshot taken at order time so historical orders need no product join
+    name: Optional[str] = None
+    size: Optional[str] = None
+    brand: Optional[str] = None
+    category: Optional[str] = None
+    unit_price: Optional[float] = None
+
+LINE_ITEM_FIELDS = ("name", "size", "brand", "category")
+LINE_ITEM_PROJECTION = {"_id": 0, "id": 1, "price": 1, "variants": 1, **{f: 1 for f in LINE_ITEM_FIELDS}}
 
 class Address(BaseModel):
     name: str
@@ -105,12 +466,13 @@ class Order(BaseModel):
 class OrderDeliveryCreate(BaseModel):
     items: List[CartItem]
     address: Address
-    id_image: Optional[str] = None  # Base64 encoded ID image
+    id_image: Optional[str] = None  # Base64 encoded ID image (older clients)
+    id_upload: Optional[str] = None  # upload_id from /api/uploads/id
 
 class OrderDelivery(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    items: List[CartItem]
+    items: List[OrderLineItem]
     address: Address
     subtotal: float
     delivery_fee: float
@@ -158,67 +520,387 @@ def haversine_miles(lat1, lon1, lat2, lon2):
     a = math.sin(dphi/2)**2 + math.cos(p1)*math.cos(p2)*math.sin(dl/2)**2
     return 2 * R * math.asin(math.sqrt(a))
 
+ZIP_GEOCODER_URL = os.environ.get('ZIP_GEOCODER_URL', 'https://api.zippopotam.us/us').rstrip('/')
+
 def geocode_zip(zip_code: str):
+    with trace_span("geocode_zip", kind=3, zip=zip_code) as span:
+        try:
+            with urlopen(f"{ZIP_GEOCODER_URL}/{zip_code}", timeout=5) as f:
+                data = json.loads(f.read().decode("utf-8"))
+                place = data["places"][0]
+                lat = float(place["latitude"]); lon = float(place["longitude"])
+                state = data.get("state abbreviation") or place.get("state abbreviation")
+                return lat, lon, (state or "")
+        except Exception as e:
+            span_error(span, e)
+            logger.warning("Geocode failed for %s: %r", zip_code, e)
+            return None
+
+# ZIP centroids never change, so successful lookups are kept for the life of the process
+_zip_cache = {}
+ZIP_CACHE_MAX = 10000
+
+async def lookup_zip(zip_code: str):
+    geo = _zip_cache.get(zip_code)
+    if geo is None:
+        geo = await asyncio.to_thread(geocode_zip, zip_code)
+        if geo and len(_zip_cache) < ZIP_CACHE_MAX:
+            _zip_cache[zip_code] = geo
+    return geo
+
+# ---- Read routing ----
+# Each class of query reads through reader(collection, route), which applies the
+# route's read preference and read concern. Catalog browsing and admin/reporting
+# reads go to secondaries with bounded staleness; checkout, payment and order
+# lookups stay on the primary (the plain `db` handle). Against a standalone or a
+# local single-node replica set (mongod --replSet rs0; rs.initiate()) the
+# secondaryPreferred routes simply fall back to the primary.
+READ_PREFERENCES = {
+    "primary": Primary, "primaryPreferred": PrimaryPreferred, "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred, "nearest": Nearest,
+}
+MAX_STALENESS_SECONDS = int(os.environ.get('MAX_STALENESS_SECONDS', '90'))  # 90 is the server minimum; -1 disables
+READ_ROUTES = {
+    "catalog": (os.environ.get('READ_PREF_CATALOG', 'secondaryPreferred'), os.environ.get('READ_CONCERN_CATALOG', 'local')),
+    "admin": (os.environ.get('READ_PREF_ADMIN', 'secondaryPreferred'), os.environ.get('READ_CONCERN_ADMIN', 'local')),
+    "primary": ('primary', os.environ.get('READ_CONCERN_PRIMARY', 'local')),
+}
+_readers = {}
+
+def _read_preference(name):
+    cls = READ_PREFERENCES[name]
+    if cls is Primary:
+        return Primary()
+    return cls(max_staleness=MAX_STALENESS_SECONDS)
+
+def reader(collection, route):
+    key = (collection, route)
+    if key not in _readers:
+        pref, concern = READ_ROUTES[route]
+        _readers[key] = db.get_collection(collection, read_preference=_read_preference(pref), read_concern=ReadConcern(concern))
+    return _readers[key]
+
+# ---- Database deadlines and circuit breaker ----
+# Request-path Mongo calls go through db_call(), which applies a deadline and feeds
+# a circuit breaker. After sustained errors or slow calls the breaker opens: reads
+# fall back to the last-known-good catalog snapshot (flagged stale) and writes get
+# an immediate 503 instead of queueing behind a stalled database.
+DB_READ_TIMEOUT = float(os.environ.get('DB_READ_TIMEOUT', '2.0'))
+DB_WRITE_TIMEOUT = float(os.environ.get('DB_WRITE_TIMEOUT', '5.0'))
+DB_LIST_TIMEOUT = float(os.environ.get('DB_LIST_TIMEOUT', '10.0'))
+
+class DatabaseUnavailable(Exception):
+    pass
+
+class CircuitBreaker:
+    """Opens when the failure ratio over the last `window` calls reaches `threshold`
+    (slow calls count as failures); after `cooldown` seconds one trial call is let through."""
+    def __init__(self, window=20, threshold=0.5, min_calls=5, slow_seconds=1.0, cooldown=10.0):
+        self.window = deque(maxlen=window)
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def release(self):
+        """End a half-open trial that produced no verdict (cancelled, or an HTTPException)."""
+        self.trial_in_flight = False
+
+    def record(self, ok, elapsed, trial=False):
+        """Pass trial=True only for the call allow() admitted as the half-open trial."""
+        failed = not ok or elapsed >= self.slow_seconds
+        if self.opened_at is not None:
+            if not trial:
+                return  # started before the breaker opened; says nothing about recovery
+            self.trial_in_flight = False
+            if failed:
+                self.opened_at = time.monotonic()
+            else:
+                self.opened_at = None
+                self.window.clear()
+            return
+        self.window.append(failed)
+        if len(self.window) >= self.min_calls and sum(self.window) / len(self.window) >= self.threshold:
+            self.opened_at = time.monotonic()
+            logger.warning("Database circuit breaker opened")
+
+db_breaker = CircuitBreaker(
+    slow_seconds=float(os.environ.get('DB_SLOW_SECONDS', '1.0')),
+    cooldown=float(os.environ.get('DB_BREAKER_COOLDOWN', '10')),
+)
+
+async def db_call(aw, timeout=DB_READ_TIMEOUT, expect_slow=False):
+    """Await a Mongo operation under a deadline. Pass expect_slow for large listings so
+    their normal latency does not count against the breaker."""
+    trial = db_breaker.state == "half_open"
+    if not db_breaker.allow():
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        raise DatabaseUnavailable("circuit open")
+    started = time.monotonic()
     try:
-        with urlopen(f"https://api.zippopotam.us/us/{zip_code}", timeout=5) as f:
-            data = json.loads(f.read().decode("utf-8"))
-            place = data["places"][0]
-            lat = float(place["latitude"]); lon = float(place["longitude"])
-            state = data.get("state abbreviation") or place.get("state abbreviation")
-            return lat, lon, (state or "")
-    except Exception:
-        return None
+        result = await asyncio.wait_for(aw, timeout=timeout)
+    except asyncio.TimeoutError:
+        db_breaker.record(False, time.monotonic() - started, trial)
+        raise DatabaseUnavailable("deadline exceeded")
+    except HTTPException:
+        raise
+    except Exception as e:
+        db_breaker.record(False, time.monotonic() - started, trial)
+        raise DatabaseUnavailable(str(e)) from e
+    else:
+        db_breaker.record(True, 0.0 if expect_slow else time.monotonic() - started, trial)
+        return result
+    finally:
+        # Without this a cancelled trial would hold the breaker half-open for good
+        if trial:
+            db_breaker.release()
+
+@app.exception_handler(DatabaseUnavailable)
+async def database_unavailable_handler(request: Request, exc: DatabaseUnavailable):
+    return JSONResponse(status_code=503, content={"detail": "Database temporarily unavailable"}, headers={"Retry-After": str(int(db_breaker.cooldown))})
+
+# Last-known-good catalog, refreshed by every successful list_products
+_catalog_snapshot = {"products": None, "at": None}
+
+def _stale_headers(response):
+    response.headers["X-Data-Stale"] = "true"
+    response.headers["Warning"] = '110 - "Response is Stale"'
+    if _catalog_snapshot["at"]:
+        response.headers["X-Data-As-Of"] = _catalog_snapshot["at"]
+    return response
+
+# ---- Pre-compressed response cache ----
+# Cacheable JSON responses are compressed once per (content digest, encoding) and
+# served from memory afterwards. The digest doubles as a (weak) ETag, and because it
+# is derived from the bytes themselves every worker agrees on it without coordination.
+# Responses that already carry Content-Encoding are passed through by GZipMiddleware.
+COMPRESS_MIN_SIZE = 500
+COMPRESS_CACHE_MAX_BYTES = int(os.environ.get('COMPRESS_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+_compress_cache = OrderedDict()
+_compress_cache_bytes = 0
+
+COMPRESSORS = {"gzip": lambda body: gzip.compress(body, compresslevel=6)}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = lambda body: zstandard.ZstdCompressor(level=10).compress(body)
+if brotli is not None:
+    COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=9)
+ENCODING_PREFERENCE = ("br", "zstd", "gzip")
+
+def accepted_encodings(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name] = q
+    return accepted
+
+def negotiate_encoding(accept_encoding, available=None):
+    accepted = accepted_encodings(accept_encoding)
+    for enc in ENCODING_PREFERENCE:
+        if available is not None and enc not in available:
+            continue
+        if enc in COMPRESSORS and accepted.get(enc, accepted.get("*", 0)) > 0:
+            return enc
+    return None
+
+def _compressed(digest, encoding, body):
+    global _compress_cache_bytes
+    key = (digest, encoding)
+    hit = _compress_cache.get(key)
+    if hit is not None:
+        _compress_cache.move_to_end(key)
+        return hit
+    data = COMPRESSORS[encoding](body)
+    _compress_cache[key] = data
+    _compress_cache_bytes += len(data)
+    while _compress_cache_bytes > COMPRESS_CACHE_MAX_BYTES and len(_compress_cache) > 1:
+        _, old = _compress_cache.popitem(last=False)
+        _compress_cache_bytes -= len(old)
+    return data
+
+def cached_json_response(request: Request, body: bytes, max_age: int = 0, media_type: str = "application/json", private: bool = False):
+    """Pass private=True for bodies with customer data so no shared cache or CDN stores them;
+    those are also compressed per response instead of through the LRU, where these one-off
+    bodies would only push out the catalog. The ETag is weak: the br/zstd/gzip/identity
+    representations share it."""
+    digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+    cache_control = "private, no-store" if private else f"public, max-age={max_age}" if max_age else "no-cache"
+    headers = {"ETag": f'W/"{digest}"', "Vary": "Accept-Encoding", "Cache-Control": cache_control}
+    if_none_match = {tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")}
+    if f'"{digest}"' in if_none_match:
+        return Response(status_code=304, headers=headers)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding")) if len(body) >= COMPRESS_MIN_SIZE else None
+    if encoding:
+        body = COMPRESSORS[encoding](body) if private else _compressed(digest, encoding, body)
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=media_type, headers=headers)
 
 @api_router.get("/")
 async def root():
     return {"message": "Hello World"}
 
+# ---- Dependency health ----
+# A background prober checks each dependency every HEALTH_PROBE_SECONDS and keeps
+# rolling stats, so /api/health and /api/ready answer from memory instead of
+# pinging Mongo on every load balancer probe. Point ZIP_GEOCODER_URL (and swap
+# HEALTH_PROBES entries) at local stand-ins for tests.
+HEALTH_PROBE_SECONDS = float(os.environ.get('HEALTH_PROBE_SECONDS', '10'))
+HEALTH_PROBE_TIMEOUT = float(os.environ.get('HEALTH_PROBE_TIMEOUT', '5'))
+HEALTH_WINDOW = 50
+
+async def _probe_mongo():
+    await db.command("ping")
+
+async def _probe_square():
+    await asyncio.to_thread(square_client.locations.list)
+
+async def _probe_geocoder():
+    if not await asyncio.to_thread(geocode_zip, ORIGIN_ZIP):
+        raise RuntimeError("Geocoder lookup failed")
+
+HEALTH_PROBES = {"mongo": _probe_mongo, "geocoder": _probe_geocoder}
+if SQUARE_ACCESS_TOKEN:
+    HEALTH_PROBES["square"] = _probe_square
+HEALTH_CRITICAL = {"mongo"}
+_health_latencies = {name: deque(maxlen=HEALTH_WINDOW) for name in HEALTH_PROBES}
+dependency_health = {name: {"ok": None, "checks": 0, "errors": 0, "consecutive_failures": 0} for name in HEALTH_PROBES}
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))] if ordered else None
+
+async def _run_probe(name, probe):
+    started = time.perf_counter()
+    error = None
+    try:
+        await asyncio.wait_for(probe(), timeout=HEALTH_PROBE_TIMEOUT)
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    latency_ms = round((time.perf_counter() - started) * 1000, 2)
+    window = _health_latencies[name]
+    window.append(latency_ms)
+    state = dependency_health[name]
+    state.update(
+        ok=error is None,
+        checks=state["checks"] + 1,
+        errors=state["errors"] + (error is not None),
+        consecutive_failures=0 if error is None else state["consecutive_failures"] + 1,
+        last_latency_ms=latency_ms,
+        p50_ms=_percentile(window, 0.5),
+        p95_ms=_percentile(window, 0.95),
+        last_checked=datetime.now(timezone.utc).isoformat(),
+    )
+    if error is None:
+        state["last_ok"] = state["last_checked"]
+    else:
+        state["last_error"] = error
+
+async def probe_dependencies():
+    await asyncio.gather(*(_run_probe(name, probe) for name, probe in HEALTH_PROBES.items()))
+
+async def health_probe_loop():
+    while True:
+        await asyncio.sleep(HEALTH_PROBE_SECONDS)
+        try:
+            await probe_dependencies()
+        except Exception as e:
+            logger.warning("Health probe failed: %s", e)
+
 @api_router.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {"status": "ok", "dependencies": dependency_health, "db_breaker": db_breaker.state}
 
 @api_router.get("/ready")
 async def ready():
-    try:
-        await db.command("ping")
-        return {"status": "ready", "mongo": True}
-    except Exception as e:
-        return {"status": "degraded", "mongo": False, "error": str(e)}
+    """Readiness for load balancers: 503 until the first probe has run and whenever a
+    critical dependency is down; a degraded non-critical dependency still answers 200."""
+    mongo = dependency_health["mongo"]
+    if mongo["ok"] is None:
+        return JSONResponse(status_code=503, content={"status": "starting", "mongo": False})
+    critical_ok = all(dependency_health[name]["ok"] for name in HEALTH_CRITICAL)
+    all_ok = all(state["ok"] for state in dependency_health.values())
+    body = {"status": "ready" if all_ok else "degraded", "mongo": bool(mongo["ok"]), "dependencies": dependency_health}
+    if not critical_ok:
+        body["status"] = "unavailable"
+        body["error"] = mongo.get("last_error")
+        return JSONResponse(status_code=503, content=body)
+    return body
 
 @api_router.post("/products", response_model=Product)
 async def create_product(payload: ProductCreate):
     product = Product(**payload.model_dump())
     doc = product.model_dump(); doc['created_at'] = doc['created_at'].isoformat()
-    await db.products.insert_one(doc)
+    await db_call(db.products.insert_one(doc), DB_WRITE_TIMEOUT)
+    invalidate_catalog([product.id])
     return product
 
+product_list_adapter = TypeAdapter(List[Product])
+
 @api_router.get("/products", response_model=List[Product])
-async def list_products():
-    products = await db.products.find({}, {"_id": 0}).to_list(800)
+async def list_products(request: Request):
+    try:
+        products = await db_call(reader("products", "catalog").find({}, {"_id": 0}).max_time_ms(DB_MAX_TIME_MS).to_list(800))
+    except DatabaseUnavailable:
+        if _catalog_snapshot["products"] is None:
+            raise
+        return _stale_headers(cached_json_response(request, product_list_adapter.dump_json(_catalog_snapshot["products"])))
     for p in products:
         if isinstance(p.get('created_at'), str):
             p['created_at'] = datetime.fromisoformat(p['created_at'])
-    return products
+    validated = product_list_adapter.validate_python(products)
+    _catalog_snapshot.update(products=validated, at=datetime.now(timezone.utc).isoformat())
+    return cached_json_response(request, product_list_adapter.dump_json(validated), max_age=60)
 
 @api_router.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str):
-    p = await db.products.find_one({"id": product_id}, {"_id": 0})
+async def get_product(product_id: str, request: Request):
+    try:
+        p = await db_call(reader("products", "catalog").find_one({"id": product_id}, {"_id": 0}, max_time_ms=DB_MAX_TIME_MS))
+    except DatabaseUnavailable:
+        cached = next((x for x in _catalog_snapshot["products"] or [] if x.id == product_id), None)
+        if cached is None:
+            raise
+        return _stale_headers(cached_json_response(request, cached.model_dump_json().encode()))
     if not p:
         raise HTTPException(status_code=404, detail="Product not found")
     if isinstance(p.get('created_at'), str):
         p['created_at'] = datetime.fromisoformat(p['created_at'])
-    return p
+    return cached_json_response(request, Product.model_validate(p).model_dump_json().encode(), max_age=60)
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str):
-    res = await db.products.delete_one({"id": product_id})
+    res = await db_call(db.products.delete_one({"id": product_id}), DB_WRITE_TIMEOUT)
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    invalidate_catalog([product_id])
     return {"ok": True}
 
 @api_router.post("/delivery/quote", response_model=DeliveryQuoteResponse)
 async def delivery_quote(payload: DeliveryQuoteRequest):
-    geo = geocode_zip(payload.zip)
+    geo = await lookup_zip(payload.zip)
     if not geo:
         return DeliveryQuoteResponse(allowed=False, fee=0.0, min_order=0.0, reason="Invalid ZIP")
     lat, lon, state = geo
@@ -239,6 +921,343 @@ async def delivery_quote(payload: DeliveryQuoteRequest):
     reason = None if allowed else f"Minimum order ${min_order:.2f} ({name})"
     return DeliveryQuoteResponse(allowed=allowed, fee=float(fee), min_order=float(min_order), tier=name, reason=reason, distance_miles=round(dist,2))
 
+# ---- Cart pricing ----
+# /api/cart/price prices a whole cart against an in-process catalog snapshot and folds
+# in the delivery quote, so checkout needs one pricing round-trip before order creation.
+# Order creation still re-prices against the primary, using the same price_lines().
+CATALOG_TTL_SECONDS = float(os.environ.get('CATALOG_TTL_SECONDS', '30'))
+_catalog_cache = {"by_id": None, "loaded": 0.0, "primary_until": 0.0}
+# After a catalog write, snapshot reloads read the primary until secondaries are
+# guaranteed (max staleness) to have caught up
+CATALOG_PRIMARY_WINDOW_SECONDS = MAX_STALENESS_SECONDS if MAX_STALENESS_SECONDS > 0 else 90
+
+def catalog_read_route():
+    return "primary" if time.monotonic() < _catalog_cache["primary_until"] else "catalog"
+_catalog_lock = asyncio.Lock()
+
+async def catalog_by_id():
+    """Return {product_id: product}, reloading at most once per TTL across concurrent callers."""
+    def fresh():
+        return _catalog_cache["by_id"] is not None and time.monotonic() - _catalog_cache["loaded"] < CATALOG_TTL_SECONDS
+    if fresh():
+        return _catalog_cache["by_id"]
+    async with _catalog_lock:
+        if not fresh():
+            try:
+                products = await db_call(reader("products", catalog_read_route()).find({}, LINE_ITEM_PROJECTION).max_time_ms(DB_MAX_TIME_MS).to_list(None))
+            except DatabaseUnavailable:
+                if _catalog_cache["by_id"] is None:
+                    raise
+                return _catalog_cache["by_id"]
+            _catalog_cache.update(by_id={p["id"]: p for p in products}, loaded=time.monotonic())
+    return _catalog_cache["by_id"]
+
+def invalidate_catalog(product_ids=None):
+    """Call after catalog writes; pass the affected ids when known so the related-products
+    index can be updated incrementally instead of rebuilt."""
+    _catalog_cache["loaded"] = 0.0
+    _catalog_cache["primary_until"] = time.monotonic() + CATALOG_PRIMARY_WINDOW_SECONDS
+    _index_cache["at"] = 0.0
+    if product_ids is None:
+        related_index.stale = True
+    else:
+        related_index.dirty.update(product_ids)
+
+def price_lines(items, product_map):
+    """Price cart items; returns (line_items, subtotal, errors)."""
+    subtotal = 0.0
+    line_items, errors = [], []
+    for it in items:
+        p = product_map.get(it.product_id)
+        if p is None:
+            errors.append({"product_id": it.product_id, "error": f"Invalid product {it.product_id}"})
+            continue
+        if it.quantity < 1:
+            errors.append({"product_id": it.product_id, "error": f"Invalid quantity for {p.get('name') or it.product_id}"})
+            continue
+        variant_names = {v.get("name") for v in p.get("variants") or [] if isinstance(v, dict)}
+        if it.variant and variant_names and it.variant not in variant_names:
+            errors.append({"product_id": it.product_id, "error": f"Unknown variant {it.variant} for {p.get('name')}"})
+            continue
+        subtotal += p['price'] * it.quantity
+        line_items.append(OrderLineItem(**it.model_dump(), unit_price=p['price'], **{f: p.get(f) for f in LINE_ITEM_FIELDS}))
+    return line_items, subtotal, errors
+
+class CartPriceRequest(BaseModel):
+    items: List[CartItem]
+    zip: Optional[str] = None
+
+@api_router.post("/cart/price")
+async def price_cart(payload: CartPriceRequest):
+    """Authoritative cart subtotal, line prices and delivery quote in one response"""
+    line_items, subtotal, errors = price_lines(payload.items, await catalog_by_id())
+    subtotal = round(subtotal, 2)
+    quote = await delivery_quote(DeliveryQuoteRequest(zip=payload.zip, subtotal=subtotal)) if payload.zip else None
+    fee = quote.fee if quote and quote.allowed else 0.0
+    return {
+        "items": [{**li.model_dump(), "line_total": round(li.unit_price * li.quantity, 2)} for li in line_items],
+        "subtotal": subtotal,
+        "quote": quote,
+        "total": round(subtotal + fee, 2),
+        "errors": errors,
+        "valid": not errors and bool(line_items) and bool(quote and quote.allowed),
+    }
+
+# ---- Related products ----
+# Product pages fetch /api/products/{id}/related instead of the whole catalog. Similarity
+# is the weighted count of shared attributes, found through an inverted index
+# (attribute -> product ids); a shared price band only breaks ties between products that
+# already have something in common. Creates and deletes mark ids dirty, and the next lookup
+# re-ranks just those products and their neighbours. Bulk imports and the periodic rebuild
+# (RELATED_REBUILD_SECONDS, for edits made outside the API) re-index everything.
+RELATED_WEIGHTS = {"category": 4.0, "product_type": 2.0, "brand": 2.0, "strain_type": 1.5, "strain": 0.5}
+RELATED_PRICE_BAND_WEIGHT = 1.0
+RELATED_PRICE_BANDS = (15.0, 30.0, 60.0, 100.0)
+RELATED_TOP_K = 12
+RELATED_REBUILD_SECONDS = float(os.environ.get('RELATED_REBUILD_SECONDS', '900'))
+RELATED_CARD_FIELDS = ("id", "name", "price", "image_url", "category", "brand", "size")
+RELATED_PROJECTION = {"_id": 0, "variants": 1, "product_type": 1, "strain_type": 1, **{f: 1 for f in RELATED_CARD_FIELDS}}
+
+def _related_features(p):
+    feats = {(k, str(p[k]).strip().lower()) for k in ("category", "product_type", "brand", "strain_type") if p.get(k)}
+    for v in p.get("variants") or []:
+        name = v.get("name") if isinstance(v, dict) else v
+        if name:
+            feats.add(("strain", str(name).strip().lower()))
+    return frozenset(feats)
+
+class RelatedIndex:
+    """Lookups read self.state once; rebuild() and update() build a new
+    (entries, postings, related) tuple and swap it in whole, so a reader never sees a
+    half-built index."""
+    def __init__(self):
+        # id -> (features, price band, card); feature -> ids; id -> ids, best match first
+        self.state = ({}, {}, {})
+        self.dirty = set()
+        self.stale = True
+        self.built_at = 0.0
+
+    @staticmethod
+    def _posting(postings, feature, copied):
+        # update() shares the posting sets of the live state; copy each one before changing it
+        if copied is not None and feature not in copied:
+            postings[feature] = set(postings.get(feature, ()))
+            copied.add(feature)
+        return postings.setdefault(feature, set())
+
+    def _put(self, entries, postings, p, copied=None):
+        price = float(p.get("price") or 0)
+        card = {f: p.get(f) for f in RELATED_CARD_FIELDS}
+        feats = _related_features(p)
+        entries[p["id"]] = (feats, bisect.bisect_right(RELATED_PRICE_BANDS, price), card)
+        for f in feats:
+            self._posting(postings, f, copied).add(p["id"])
+
+    def _drop(self, entries, postings, pid, copied):
+        feats = entries.pop(pid)[0]
+        for f in feats:
+            ids = self._posting(postings, f, copied)
+            ids.discard(pid)
+            if not ids:
+                del postings[f]
+        return feats
+
+    @staticmethod
+    def _neighbours(postings, feats):
+        out = set()
+        for f in feats:
+            out |= postings.get(f, set())
+        return out
+
+    @staticmethod
+    def _rank(entries, postings, pid):
+        feats, band, card = entries[pid]
+        scores = {}
+        for f in feats:
+            weight = RELATED_WEIGHTS[f[0]]
+            for other in postings.get(f, ()):
+                if other != pid:
+                    scores[other] = scores.get(other, 0.0) + weight
+        def key(other):
+            o_band, o_card = entries[other][1:]
+            bonus = RELATED_PRICE_BAND_WEIGHT if o_band == band else 0.0
+            return (-(scores[other] + bonus), abs((o_card["price"] or 0) - (card["price"] or 0)), o_card["name"] or "")
+        return heapq.nsmallest(RELATED_TOP_K, scores, key=key)
+
+    def rebuild(self, products):
+        entries, postings = {}, {}
+        for p in products:
+            self._put(entries, postings, p)
+        related = {pid: self._rank(entries, postings, pid) for pid in entries}
+        self.state = (entries, postings, related)
+        self.stale = False
+        self.built_at = time.monotonic()
+
+    def update(self, products, ids):
+        """Re-index the given ids (products holds the ones that still exist)."""
+        entries, postings, related = (dict(part) for part in self.state)
+        copied = set()
+        affected = {pid for pid, rel in related.items() if not ids.isdisjoint(rel)}
+        for pid in ids:
+            if pid in entries:
+                affected |= self._neighbours(postings, self._drop(entries, postings, pid, copied))
+            related.pop(pid, None)
+        for p in products:
+            self._put(entries, postings, p, copied)
+            affected |= self._neighbours(postings, entries[p["id"]][0])
+        for pid in affected:
+            if pid in entries:
+                related[pid] = self._rank(entries, postings, pid)
+        self.state = (entries, postings, related)
+
+    def cards(self, pid, limit):
+        """Related product cards, or None when pid is not in the index."""
+        entries, _, related = self.state
+        if pid not in entries:
+            return None
+        return [entries[o][2] for o in related.get(pid, [])[:limit] if o in entries]
+
+related_index = RelatedIndex()
+_related_lock = asyncio.Lock()
+
+async def refresh_related_index():
+    idx = related_index
+    def current():
+        return not idx.stale and not idx.dirty and time.monotonic() - idx.built_at < RELATED_REBUILD_SECONDS
+    if current():
+        return
+    async with _related_lock:
+        if current():
+            return
+        full = idx.stale or time.monotonic() - idx.built_at >= RELATED_REBUILD_SECONDS
+        ids, idx.dirty = idx.dirty, set()
+        # Dirty ids are read from the primary: a lagging secondary would make a just-created
+        # product look deleted until the next full rebuild
+        query, route = ({}, catalog_read_route()) if full else ({"id": {"$in": list(ids)}}, "primary")
+        try:
+            products = await db_call(reader("products", route).find(query, RELATED_PROJECTION).max_time_ms(DB_MAX_TIME_MS).to_list(None))
+        except DatabaseUnavailable:
+            idx.dirty |= ids
+            if not idx.built_at:
+                raise
+            return
+        if full:
+            await asyncio.to_thread(idx.rebuild, products)
+        else:
+            await asyncio.to_thread(idx.update, products, ids)
+
+@api_router.get("/products/{product_id}/related")
+async def get_related_products(product_id: str, request: Request, limit: int = 4):
+    await refresh_related_index()
+    limit = max(1, min(limit, RELATED_TOP_K))
+    cards = related_index.cards(product_id, limit)
+    if cards is None:
+        # The index is per worker, so a product created through another worker may not be
+        # in this one yet: confirm on the primary and index it before answering 404
+        if not await db_call(reader("products", "primary").find_one({"id": product_id}, {"_id": 1})):
+            raise HTTPException(status_code=404, detail="Product not found")
+        related_index.dirty.add(product_id)
+        await refresh_related_index()
+        cards = related_index.cards(product_id, limit)
+        if cards is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+    return cached_json_response(request, json.dumps(cards, separators=(",", ":")).encode(), max_age=60)
+
+# ---- ID uploads ----
+# ID photos are uploaded ahead of checkout as multipart (field "file") to /api/uploads/id
+# and referenced from the order as id_upload, so order JSON stays small. The body is
+# counted as it streams in and refused once it passes the limit; the file part spools to
+# disk past 1MB. Pillow (optional) downscales and re-encodes the image on a small
+# dedicated pool; without it, only the type sniff runs and the bytes are kept as sent.
+# Unclaimed uploads expire through a TTL index.
+ID_UPLOAD_MAX_BYTES = int(os.environ.get('ID_UPLOAD_MAX_BYTES', str(10 * 1024 * 1024)))
+ID_UPLOAD_TTL_SECONDS = int(os.environ.get('ID_UPLOAD_TTL_SECONDS', '3600'))
+ID_IMAGE_MAX_EDGE = int(os.environ.get('ID_IMAGE_MAX_EDGE', '1600'))
+ID_IMAGE_QUALITY = int(os.environ.get('ID_IMAGE_QUALITY', '80'))
+ID_IMAGE_MAX_PIXELS = 50_000_000
+ID_IMAGE_TYPES = ("image/jpeg", "image/png", "image/webp")
+_id_image_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('ID_IMAGE_WORKERS', '2')), thread_name_prefix="id-image")
+
+def _sniff_image(head):
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def _prepare_id_image(fileobj):
+    """Returns (bytes, content_type, width, height); raises ValueError for unusable images."""
+    fileobj.seek(0)
+    kind = _sniff_image(fileobj.read(16))
+    fileobj.seek(0)
+    if kind is None:
+        raise ValueError("File is not a JPEG, PNG or WebP image")
+    if Image is None:
+        return fileobj.read(), kind, None, None
+    try:
+        with Image.open(fileobj) as im:
+            if im.width * im.height > ID_IMAGE_MAX_PIXELS:
+                raise ValueError("Image dimensions are too large")
+            im.draft("RGB", (ID_IMAGE_MAX_EDGE, ID_IMAGE_MAX_EDGE))  # JPEG decodes at a reduced scale
+            im = ImageOps.exif_transpose(im).convert("RGB")
+            im.thumbnail((ID_IMAGE_MAX_EDGE, ID_IMAGE_MAX_EDGE), Image.LANCZOS)
+            out = io.BytesIO()
+            im.save(out, "JPEG", quality=ID_IMAGE_QUALITY, optimize=True)
+            return out.getvalue(), "image/jpeg", im.width, im.height
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Unreadable image: {e}") from e
+
+@api_router.post("/uploads/id")
+async def upload_id_image(request: Request):
+    """Upload an ID photo; returns the upload_id to send as id_upload with the order"""
+    limit = ID_UPLOAD_MAX_BYTES + 64 * 1024  # multipart framing and the small text fields
+    too_large = HTTPException(status_code=413, detail=f"ID image must be under {ID_UPLOAD_MAX_BYTES // (1024 * 1024)}MB")
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit:
+        raise too_large
+
+    async def limited_stream():
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > limit:
+                raise too_large
+            yield chunk
+
+    try:
+        form = await MultiPartParser(request.headers, limited_stream(), max_files=1, max_fields=2).parse()
+    except MultiPartException as e:
+        raise HTTPException(status_code=400, detail=e.message)
+    try:
+        upload = form.get("file")
+        if not isinstance(upload, UploadFile):
+            raise HTTPException(status_code=400, detail="Send the image as multipart field 'file'")
+        if (upload.content_type or "").lower() not in ID_IMAGE_TYPES:
+            raise HTTPException(status_code=415, detail="ID image must be JPEG, PNG or WebP")
+        if upload.size is not None and upload.size > ID_UPLOAD_MAX_BYTES:
+            raise too_large
+        with trace_span("id_image.prepare", bytes=upload.size or 0):
+            try:
+                data, content_type, width, height = await asyncio.get_running_loop().run_in_executor(_id_image_pool, _prepare_id_image, upload.file)
+            except ValueError as e:
+                raise HTTPException(status_code=415, detail=str(e))
+    finally:
+        await form.close()
+    upload_id = str(uuid.uuid4())
+    await db_call(writer("id_uploads", "orders").insert_one({
+        "id": upload_id, "data": data, "content_type": content_type, "created_at": datetime.now(timezone.utc),
+    }), DB_WRITE_TIMEOUT)
+    return {"upload_id": upload_id, "content_type": content_type, "bytes": len(data), "width": width, "height": height}
+
+async def claim_id_upload(upload_id):
+    """Stored upload as a data URL (the form orders keep id_image in), or None if unknown/expired."""
+    upload = await db_call(db.id_uploads.find_one({"id": upload_id}, {"_id": 0, "data": 1, "content_type": 1}))
+    if not upload:
+        return None
+    return f"data:{upload['content_type']};base64,{base64.b64encode(upload['data']).decode('ascii')}"
+
 @api_router.post("/orders/delivery")
 async def create_delivery_order(payload: OrderDeliveryCreate):
     try:
@@ -253,86 +1272,154 @@ async def create_delivery_order(payload: OrderDeliveryCreate):
         raise HTTPException(status_code=400, detail="Texas only")
     
     # Validate ID image is provided
-    if not payload.id_image:
+    if not payload.id_image and not payload.id_upload:
         raise HTTPException(status_code=400, detail="ID image is required for age verification")
     
     ids = [i.product_id for i in payload.items]
-    found = await db.products.find({"id": {"$in": ids}}, {"_id": 0, "id": 1, "price": 1}).to_list(800)
-    price_map = {p['id']: p['price'] for p in found}
-    subtotal = 0.0
-    for it in payload.items:
-        price = price_map.get(it.product_id)
-        if price is None:
-            raise HTTPException(status_code=400, detail=f"Invalid product {it.product_id}")
-        subtotal += price * it.quantity
-    q = await delivery_quote(DeliveryQuoteRequest(zip=payload.address.zip, subtotal=subtotal))
+    found = await db_call(db.products.find({"id": {"$in": ids}}, LINE_ITEM_PROJECTION).to_list(800))
+    line_items, subtotal, errors = price_lines(payload.items, {p['id']: p for p in found})
+    if errors:
+        raise HTTPException(status_code=400, detail=errors[0]["error"])
+    with trace_span("delivery_quote", zip=payload.address.zip, subtotal=subtotal) as span:
+        q = await delivery_quote(DeliveryQuoteRequest(zip=payload.address.zip, subtotal=subtotal))
+        if span is not None:
+            span["attributes"].update(allowed=q.allowed, tier=q.tier or "")
     if not q.allowed:
         raise HTTPException(status_code=400, detail=q.reason or "Not allowed")
+    id_image = payload.id_image
+    if payload.id_upload:
+        id_image = await claim_id_upload(payload.id_upload)
+        if id_image is None:
+            raise HTTPException(status_code=400, detail="ID upload expired, please upload your ID again")
     tax = 0.0
     total = round(subtotal + q.fee + tax, 2)
     order = OrderDelivery(
-        items=payload.items,
+        items=line_items,
         address=payload.address,
         subtotal=round(subtotal, 2),
         delivery_fee=q.fee,
         tax=tax,
         total=total,
         tier=q.tier,
-        id_image=payload.id_image,  # Store the ID image
+        id_image=id_image,  # Store the ID image
     )
-    doc = order.model_dump(); doc['created_at'] = doc['created_at'].isoformat()
-    await db.delivery_orders.insert_one(doc)
+    doc = order.model_dump(); doc['created_at'] = doc['created_at'].isoformat(); doc['rollup_rev'] = 1
+    await db_call(writer("delivery_orders", "orders").insert_one(doc), DB_WRITE_TIMEOUT)
+    if payload.id_upload:
+        try:
+            await db.id_uploads.delete_one({"id": payload.id_upload})
+        except Exception as e:
+            logger.warning("ID upload cleanup failed (TTL will expire it): %s", e)
+    await apply_rollups([(order.id, 1, rollup_deltas(doc, {}, created=True, status_to=order.status))])
     return {"order_id": order.id, "total": total, "status": "pending_payment"}
 
+# order_id -> in-flight charge; concurrent requests for one order share a single Square call
+_payment_inflight = {}
+
 @api_router.post("/payments/square")
 async def process_square_payment(payment: SquarePaymentRequest):
     """Process payment using Square"""
+    inflight = _payment_inflight.get(payment.order_id)
+    if inflight is None:
+        inflight = asyncio.ensure_future(_charge_square(payment))
+        _payment_inflight[payment.order_id] = inflight
+        inflight.add_done_callback(lambda _: _payment_inflight.pop(payment.order_id, None))
+    return await asyncio.shield(inflight)
+
+def _payment_result(order_id, payment_id):
+    return {
+        "success": True,
+        "payment_id": payment_id,
+        "order_id": order_id,
+        "status": "completed"
+    }
+
+async def _charge_square(payment: SquarePaymentRequest):
     # Find the order
-    order = await db.delivery_orders.find_one({"id": payment.order_id}, {"_id": 0})
+    order = await db_call(db.delivery_orders.find_one({"id": payment.order_id}, {"_id": 0, "id_image": 0, "address": 0}))
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    # Create idempotency key
-    idempotency_key = str(uuid.uuid4())
+    # Already paid: answer from the stored state without calling Square again
+    if order.get("payment_status") == "completed":
+        return _payment_result(payment.order_id, order.get("payment_id"))
+    
+    # One idempotency key per order, shared by every worker and every retry (a double
+    # click sends a fresh card nonce, so keying on source_id would charge twice). The
+    # key only rotates once a decline has been recorded below.
+    claimed = await db_call(writer("delivery_orders", "payment").find_one_and_update(
+        {"id": payment.order_id},
+        [{"$set": {"payment_idempotency_key": {"$ifNull": ["$payment_idempotency_key", str(uuid.uuid4())]}}}],
+        projection={"_id": 0, "payment_idempotency_key": 1},
+        return_document=ReturnDocument.AFTER,
+    ), DB_WRITE_TIMEOUT)
+    if claimed is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    idempotency_key = claimed["payment_idempotency_key"]
     
     try:
-        result = square_client.payments.create(
-            source_id=payment.source_id,
-            idempotency_key=idempotency_key,
-            amount_money={
-                "amount": payment.amount,
-                "currency": payment.currency
-            },
-            location_id=SQUARE_LOCATION_ID,
-            reference_id=payment.order_id,
-            note=f"Order {payment.order_id[:8]} - XplicitkreationZ Delivery",
-            buyer_email_address=payment.customer_email if payment.customer_email else None
-        )
-        
-        payment_id = result.payment.id if result.payment else None
-        
-        # Update order with payment info
-        await db.delivery_orders.update_one(
-            {"id": payment.order_id},
+        with trace_span("square.payments.create", kind=3, order_id=payment.order_id, amount=payment.amount):
+            result = await asyncio.to_thread(
+                square_client.payments.create,
+                source_id=payment.source_id,
+                idempotency_key=idempotency_key,
+                amount_money={
+                    "amount": payment.amount,
+                    "currency": payment.currency
+                },
+                location_id=SQUARE_LOCATION_ID,
+                reference_id=payment.order_id,
+                note=f"Order {payment.order_id[:8]} - XplicitkreationZ Delivery",
+                buyer_email_address=payment.customer_email if payment.customer_email else None
+            )
+    except Exception as e:
+        codes = [getattr(err, "code", None) for err in getattr(e, "errors", None) or []]
+        logger.warning("Square payment failed", extra={"order_id": payment.order_id, "error_type": type(e).__name__, "square_codes": codes})
+        if "IDEMPOTENCY_KEY_REUSED" in codes:
+            # Another worker is charging this order with a different nonce under the same key
+            raise HTTPException(status_code=409, detail="Payment already in progress", headers={"Retry-After": "2"})
+        status = getattr(e, "status_code", None)
+        if status is None or status >= 500 or status in (408, 429):
+            # Outcome unknown: keep the key so a retry is deduplicated by Square
+            raise HTTPException(status_code=503, detail="Payment status unknown, please retry", headers={"Retry-After": "2"})
+        with contextlib.suppress(Exception):
+            await writer("delivery_orders", "payment").update_one(
+                {"id": payment.order_id, "payment_idempotency_key": idempotency_key},
+                {"$unset": {"payment_idempotency_key": ""},
+                 "$set": {"payment_declined_at": datetime.now(timezone.utc).isoformat(), "payment_decline_codes": codes}}
+            )
+        raise HTTPException(status_code=400, detail=f"Payment failed: {str(e)}")
+    
+    payment_id = result.payment.id if result.payment else None
+    
+    # The card is charged from here on: a failed write must never look like a decline.
+    # The retry reuses the key, Square returns the same payment and the write is redone.
+    try:
+        # Only the first completion counts towards rollups
+        res = await writer("delivery_orders", "payment").find_one_and_update(
+            {"id": payment.order_id, "payment_status": {"$ne": "completed"}},
             {"$set": {
                 "payment_status": "completed",
                 "payment_id": payment_id,
                 "payment_method": "square",
                 "status": "confirmed",
                 "paid_at": datetime.now(timezone.utc).isoformat()
-            }}
+            }, "$inc": {"rollup_rev": 1}},
+            projection={"_id": 0, "rollup_rev": 1},
+            return_document=ReturnDocument.AFTER,
         )
-        
-        return {
-            "success": True,
-            "payment_id": payment_id,
-            "order_id": payment.order_id,
-            "status": "completed"
-        }
-            
     except Exception as e:
-        logger.error(f"Square payment exception: {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Payment failed: {str(e)}")
+        logger.error("Charged payment not recorded", extra={"order_id": payment.order_id, "payment_id": payment_id, "error_type": type(e).__name__})
+        raise HTTPException(status_code=503, detail="Payment received, confirmation pending; please retry", headers={"Retry-After": "2"})
+    if res is not None:
+        try:
+            catalog = await rollup_catalog(order.get("items", []))
+        except Exception as e:
+            logger.warning("Rollup catalog lookup failed: %s", e)
+            catalog = {}
+        await apply_rollups([(payment.order_id, res["rollup_rev"], rollup_deltas(order, catalog, paid=True, status_from=order.get("status"), status_to="confirmed"))])
+    
+    return _payment_result(payment.order_id, payment_id)
 
 class StatusUpdate(BaseModel):
     status: str
@@ -340,24 +1427,74 @@ class StatusUpdate(BaseModel):
 
 @api_router.patch("/orders/{order_id}/status")
 async def update_order_status(order_id: str, payload: StatusUpdate):
-    res = await db.delivery_orders.update_one({"id": order_id}, {"$set": {"status": payload.status, "dispatcher_note": payload.dispatcher_note}})
-    if res.matched_count == 0:
+    prev = await db_call(writer("delivery_orders", "orders").find_one_and_update({"id": order_id}, {"$set": {"status": payload.status, "dispatcher_note": payload.dispatcher_note}, "$inc": {"rollup_rev": 1}}, projection=ROLLUP_ORDER_PROJECTION), DB_WRITE_TIMEOUT)
+    if prev is None:
         raise HTTPException(status_code=404, detail="Order not found")
+    await apply_rollups([(order_id, prev.get("rollup_rev", 0) + 1, rollup_deltas(prev, {}, status_from=prev.get("status"), status_to=payload.status))])
     return {"ok": True}
 
 # Also support admin route for status updates
 @api_router.patch("/admin/orders/{order_id}/status")
 async def admin_update_order_status(order_id: str, payload: StatusUpdate):
-    res = await db.delivery_orders.update_one({"id": order_id}, {"$set": {"status": payload.status, "dispatcher_note": payload.dispatcher_note, "updated_at": datetime.now(timezone.utc).isoformat()}})
-    if res.matched_count == 0:
+    prev = await db_call(writer("delivery_orders", "orders").find_one_and_update({"id": order_id}, {"$set": {"status": payload.status, "dispatcher_note": payload.dispatcher_note, "updated_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"rollup_rev": 1}}, projection=ROLLUP_ORDER_PROJECTION), DB_WRITE_TIMEOUT)
+    if prev is None:
         raise HTTPException(status_code=404, detail="Order not found")
+    await apply_rollups([(order_id, prev.get("rollup_rev", 0) + 1, rollup_deltas(prev, {}, status_from=prev.get("status"), status_to=payload.status))])
     return {"ok": True, "order_id": order_id, "new_status": payload.status}
 
+class BulkStatusUpdateItem(StatusUpdate):
+    order_id: str
+
+class BulkStatusUpdate(BaseModel):
+    updates: List[BulkStatusUpdateItem] = Field(max_length=500)
+
+@api_router.post("/admin/orders/status/bulk")
+async def admin_bulk_update_order_status(payload: BulkStatusUpdate):
+    """Apply many dispatcher status changes with one unordered bulk_write"""
+    ids = list({u.order_id for u in payload.updates})
+    prev = await db_call(db.delivery_orders.find({"id": {"$in": ids}}, ROLLUP_ORDER_PROJECTION).to_list(len(ids)))
+    prev_map = {o["id"]: o for o in prev}
+    now = datetime.now(timezone.utc).isoformat()
+    ops, results, events = [], [], []
+    for u in payload.updates:
+        order = prev_map.get(u.order_id)
+        if order is None:
+            results.append({"order_id": u.order_id, "ok": False, "error": "Order not found"})
+            continue
+        ops.append(UpdateOne({"id": u.order_id}, {"$set": {"status": u.status, "dispatcher_note": u.dispatcher_note, "updated_at": now}, "$inc": {"rollup_rev": 1}}))
+        rev = order.get("rollup_rev", 0) + 1
+        events.append((u.order_id, rev, rollup_deltas(order, {}, status_from=order.get("status"), status_to=u.status)))
+        # A repeated order_id chains from the status set by its earlier entry
+        prev_map[u.order_id] = {**order, "status": u.status, "rollup_rev": rev}
+        results.append({"order_id": u.order_id, "ok": True, "new_status": u.status})
+    if ops:
+        await db_call(writer("delivery_orders", "orders").bulk_write(ops, ordered=False), DB_WRITE_TIMEOUT)
+        await apply_rollups(events)
+    updated = sum(1 for r in results if r["ok"])
+    return {"ok": updated == len(payload.updates), "updated": updated, "updated_at": now, "results": results}
+
+async def hydrate_line_items(orders):
+    """Fill product details into line items that predate order-time snapshots, with one $in per page."""
+    missing = {it.get("product_id") for o in orders for it in o.get("items", []) if it.get("unit_price") is None}
+    if not missing:
+        return orders
+    found = await reader("products", "catalog").find({"id": {"$in": list(missing)}}, LINE_ITEM_PROJECTION).to_list(len(missing))
+    product_map = {p['id']: p for p in found}
+    for o in orders:
+        for it in o.get("items", []):
+            p = product_map.get(it.get("product_id"))
+            if it.get("unit_price") is None and p:
+                it["unit_price"] = p.get("price")
+                for f in LINE_ITEM_FIELDS:
+                    it.setdefault(f, p.get(f))
+    return orders
+
 @api_router.get("/admin/orders")
-async def get_admin_orders():
+async def get_admin_orders(request: Request):
     """Get all orders for the dispatcher console"""
-    cursor = db.delivery_orders.find({}, {"_id": 0}).sort("created_at", -1)
-    orders = await cursor.to_list(500)
+    cursor = reader("delivery_orders", "admin").find({}, {"_id": 0}).sort("created_at", -1)
+    orders = await db_call(cursor.to_list(500), DB_LIST_TIMEOUT, expect_slow=True)
+    await hydrate_line_items(orders)
     
     # Transform orders for frontend
     formatted_orders = []
@@ -390,7 +1527,683 @@ async def get_admin_orders():
             "payment_status": order.get("payment_status", "pending"),
         })
     
-    return {"orders": formatted_orders, "count": len(formatted_orders)}
+    body = json.dumps({"orders": formatted_orders, "count": len(formatted_orders)}, default=str).encode()
+    return cached_json_response(request, body, private=True)
+
+# ---- On-demand profiling ----
+# Nothing here runs until an operator calls it: the CPU sampler is a thread that only
+# exists for the requested window, and tracemalloc is started/stopped explicitly.
+# Guarded by ADMIN_TOKEN (sent as X-Admin-Token); disabled when the token is unset.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_MAX_SECONDS = 120
+MEMORY_SNAPSHOT_LIMIT = 5
+
+def require_admin_token(x_admin_token: Optional[str] = Header(default=None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not hmac.compare_digest((x_admin_token or "").encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(seconds, interval):
+    """Sample every thread's stack and return Brendan Gregg collapsed-stack lines."""
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(tid, f"thread-{tid}"))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {n}" for stack, n in counts.most_common()) + "\n"
+
+_cpu_profile_lock = asyncio.Lock()
+_memory_snapshots = {}
+
+@api_router.get("/admin/profile/cpu", dependencies=[Depends(require_admin_token)])
+async def admin_profile_cpu(seconds: float = 10, interval_ms: float = 5):
+    """Sample the running server for N seconds; returns a flamegraph-compatible collapsed-stack file"""
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval_ms < 1:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS}] and interval_ms >= 1")
+    if _cpu_profile_lock.locked():
+        raise HTTPException(status_code=409, detail="CPU profile already running")
+    async with _cpu_profile_lock:
+        collapsed = await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": f'attachment; filename="cpu-{stamp}.collapsed"'})
+
+@api_router.post("/admin/profile/memory/start", dependencies=[Depends(require_admin_token)])
+async def admin_memory_start(frames: int = 10):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(max(1, min(frames, 50)))
+    return {"ok": True, "tracing": True}
+
+@api_router.post("/admin/profile/memory/stop", dependencies=[Depends(require_admin_token)])
+async def admin_memory_stop():
+    tracemalloc.stop()
+    _memory_snapshots.clear()
+    return {"ok": True, "tracing": False}
+
+def _format_stats(stats, limit):
+    return [
+        {"location": str(st.traceback[0]), "size_kb": round(st.size / 1024, 1), "count": st.count,
+         "size_diff_kb": round(getattr(st, "size_diff", 0) / 1024, 1), "count_diff": getattr(st, "count_diff", 0)}
+        for st in stats[:limit]
+    ]
+
+@api_router.post("/admin/profile/memory/snapshot", dependencies=[Depends(require_admin_token)])
+async def admin_memory_snapshot(limit: int = 25):
+    """Take a tracemalloc snapshot; keeps the most recent few for diffing"""
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc not started")
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    snapshot_id = datetime.now(timezone.utc).strftime("%H%M%S%f")
+    _memory_snapshots[snapshot_id] = snapshot
+    while len(_memory_snapshots) > MEMORY_SNAPSHOT_LIMIT:
+        _memory_snapshots.pop(next(iter(_memory_snapshots)))
+    current, peak = tracemalloc.get_traced_memory()
+    return {"snapshot_id": snapshot_id, "traced_kb": round(current / 1024, 1), "peak_kb": round(peak / 1024, 1),
+            "top": _format_stats(snapshot.statistics("lineno"), limit)}
+
+@api_router.get("/admin/profile/memory/diff", dependencies=[Depends(require_admin_token)])
+async def admin_memory_diff(base: str, target: str, limit: int = 25):
+    """Compare two snapshots by allocation site, largest growth first"""
+    if base not in _memory_snapshots or target not in _memory_snapshots:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    stats = _memory_snapshots[target].compare_to(_memory_snapshots[base], "lineno")
+    return {"base": base, "target": target, "top": _format_stats(stats, limit)}
+
+@api_router.get("/admin/db/pool")
+async def admin_db_pool():
+    """Connection pool checkout waits and concurrency, for sizing MONGO_MAX_POOL_SIZE"""
+    return {"pool": pool_stats.snapshot(), "options": {k: v for k, v in MONGO_CLIENT_OPTIONS.items() if k != "appname"},
+            "write_profiles": {name: wc.document for name, wc in WRITE_PROFILES.items()}}
+
+# ---- Waitlist ----
+class WaitlistSignup(BaseModel):
+    email: EmailStr
+    source: Optional[str] = None
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings using double hashing of one blake2b digest."""
+    def __init__(self, capacity=1_000_000, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+WAITLIST_FLUSH_SECONDS = float(os.environ.get('WAITLIST_FLUSH_SECONDS', '0.5'))
+WAITLIST_FLUSH_SIZE = int(os.environ.get('WAITLIST_FLUSH_SIZE', '1000'))
+WAITLIST_MAX_ATTEMPTS = 5
+waitlist_bloom = BloomFilter(capacity=int(os.environ.get('WAITLIST_BLOOM_CAPACITY', '1000000')))
+waitlist_bloom_warm = False
+_waitlist_buffer = []
+_waitlist_attempts = {}  # signup id -> flushes that failed it with a non-duplicate error
+_waitlist_flush_event = asyncio.Event()
+_waitlist_stopping = asyncio.Event()
+
+async def warm_waitlist_bloom():
+    global waitlist_bloom_warm
+    count = 0
+    async for doc in db.waitlist.find({}, {"_id": 0, "email": 1}).batch_size(5000):
+        waitlist_bloom.add(doc["email"])
+        count += 1
+    waitlist_bloom_warm = True
+    return count
+
+async def flush_waitlist():
+    """Write buffered signups with one unordered insert_many; duplicate keys are expected and ignored."""
+    if not _waitlist_buffer:
+        return 0
+    batch = _waitlist_buffer[:]
+    del _waitlist_buffer[:]
+    try:
+        res = await writer("waitlist", "analytics").insert_many(batch, ordered=False)
+        return len(res.inserted_ids)
+    except BulkWriteError as e:
+        details = e.details or {}
+        other = [err for err in details.get("writeErrors", []) if err.get("code") != 11000]
+        requeue = []
+        for err in other:
+            # Signups were already answered "queued"; retry them with the next few flushes
+            doc = batch[err["index"]]
+            attempts = _waitlist_attempts.pop(doc["id"], 0) + 1
+            if attempts < WAITLIST_MAX_ATTEMPTS:
+                _waitlist_attempts[doc["id"]] = attempts
+                requeue.append(doc)
+            else:
+                logger.error("Dropping waitlist signup %s after %d failed flushes: %s", doc["id"], attempts, err.get("errmsg"))
+        requeued = {doc["id"] for doc in requeue}
+        for doc in batch:
+            if doc["id"] not in requeued:
+                _waitlist_attempts.pop(doc["id"], None)
+        if requeue:
+            _waitlist_buffer[:0] = requeue
+            logger.warning("Waitlist flush had %d non-duplicate errors, requeued %d: %s", len(other), len(requeue), other[0].get('errmsg'))
+        return details.get("nInserted", 0)
+    except BaseException:
+        # Anything already written comes back as a duplicate key on retry, which is ignored
+        _waitlist_buffer[:0] = batch
+        raise
+
+async def waitlist_flush_loop():
+    while not _waitlist_stopping.is_set():
+        try:
+            await asyncio.wait_for(_waitlist_flush_event.wait(), timeout=WAITLIST_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _waitlist_flush_event.clear()
+        try:
+            await flush_waitlist()
+        except Exception as e:
+            logger.warning("Waitlist flush failed: %s", e)
+
+@api_router.post("/waitlist")
+async def join_waitlist(payload: WaitlistSignup):
+    """Queue a waitlist signup. "already_registered" means the email was found in the
+    database; "queued" only means the signup was accepted. The Bloom filter is per worker
+    and misses emails added through other workers, so a queued duplicate can still happen
+    and is dropped by the unique index at flush. Only filter hits (or every signup, if the
+    warm-up failed) cost a database lookup."""
+    email = payload.email.lower()
+    maybe_known = email in waitlist_bloom or not waitlist_bloom_warm
+    if maybe_known and await db_call(db.waitlist.find_one({"email": email}, {"_id": 1})):
+        return {"ok": True, "email": email, "status": "already_registered"}
+    waitlist_bloom.add(email)
+    _waitlist_buffer.append({"id": str(uuid.uuid4()), "email": email, "source": payload.source, "created_at": datetime.now(timezone.utc).isoformat()})
+    if len(_waitlist_buffer) >= WAITLIST_FLUSH_SIZE:
+        _waitlist_flush_event.set()
+    return {"ok": True, "email": email, "status": "queued"}
+
+# ---- Hot/cold order archival ----
+# Delivered/cancelled orders older than ARCHIVE_AFTER_DAYS move from the hot
+# delivery_orders collection to delivery_orders_archive (without the ID image),
+# keeping the hot working set and its indexes small. ID images on terminal
+# orders are purged after ID_IMAGE_RETENTION_DAYS even before archival.
+ARCHIVE_COLLECTION = "delivery_orders_archive"
+ARCHIVE_TERMINAL_STATUSES = ["delivered", "cancelled"]
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+ID_IMAGE_RETENTION_DAYS = int(os.environ.get('ID_IMAGE_RETENTION_DAYS', '30'))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '3600'))
+ARCHIVE_BATCH_SIZE = 500
+
+def _cutoff(days):
+    return (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+
+async def purge_id_images():
+    res = await db.delivery_orders.update_many(
+        {"status": {"$in": ARCHIVE_TERMINAL_STATUSES}, "created_at": {"$lt": _cutoff(ID_IMAGE_RETENTION_DAYS)}, "id_image": {"$ne": None}},
+        {"$set": {"id_image": None, "id_image_purged_at": datetime.now(timezone.utc).isoformat()}},
+    )
+    return res.modified_count
+
+async def archive_orders():
+    """Move terminal orders past the cutoff into the archive collection in batches."""
+    archive = db[ARCHIVE_COLLECTION]
+    q = {"status": {"$in": ARCHIVE_TERMINAL_STATUSES}, "created_at": {"$lt": _cutoff(ARCHIVE_AFTER_DAYS)}}
+    moved = 0
+    while True:
+        batch = await db.delivery_orders.find(q, {"_id": 0, "id_image": 0}).limit(ARCHIVE_BATCH_SIZE).to_list(ARCHIVE_BATCH_SIZE)
+        if not batch:
+            break
+        now = datetime.now(timezone.utc).isoformat()
+        # Upsert first, then delete: a crash in between leaves a duplicate, never a lost order
+        await archive.bulk_write([ReplaceOne({"id": o["id"]}, {**o, "archived_at": now}, upsert=True) for o in batch], ordered=False)
+        res = await db.delivery_orders.delete_many({"id": {"$in": [o["id"] for o in batch]}})
+        moved += res.deleted_count
+        if len(batch) < ARCHIVE_BATCH_SIZE:
+            break
+    return moved
+
+async def run_archival():
+    purged = await purge_id_images()
+    archived = await archive_orders()
+    if purged or archived:
+        logger.info("Archival: purged %d ID images, archived %d orders", purged, archived)
+    return {"id_images_purged": purged, "orders_archived": archived}
+
+async def archival_loop():
+    while True:
+        try:
+            await run_archival()
+        except Exception as e:
+            logger.warning("Archival run failed: %s", e)
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+@api_router.post("/admin/orders/archive/run", dependencies=[Depends(require_admin_token)])
+async def admin_run_archival():
+    """Run one archival pass immediately"""
+    result = await run_archival()
+    return {"ok": True, **result}
+
+@api_router.get("/admin/orders/archive/{order_id}")
+async def get_archived_order(order_id: str):
+    """Look up an order in the archive, falling back to the hot collection"""
+    order = await reader(ARCHIVE_COLLECTION, "admin").find_one({"id": order_id}, {"_id": 0})
+    if not order:
+        order = await reader("delivery_orders", "admin").find_one({"id": order_id}, {"_id": 0, "id_image": 0})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return order
+
+# ---- Accounting export ----
+EXPORT_PROJECTION = {"_id": 0, "id_image": 0}
+EXPORT_COLUMNS = [
+    "id", "created_at", "updated_at", "paid_at", "status", "payment_status", "payment_method", "payment_id",
+    "tier", "subtotal", "delivery_fee", "tax", "total", "customer_name", "customer_email", "zip", "item_count", "items",
+]
+
+def _export_row(order):
+    address = order.get("address") or {}
+    items = order.get("items") or []
+    return {
+        **{k: order.get(k) for k in EXPORT_COLUMNS},
+        "customer_name": address.get("name"),
+        "customer_email": address.get("email"),
+        "zip": address.get("zip"),
+        "item_count": sum(i.get("quantity", 1) for i in items),
+        "items": ";".join(f"{i.get('product_id')}x{i.get('quantity', 1)}" for i in items),
+    }
+
+async def _export_csv(cursor):
+    buf = io.StringIO()
+    out = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+    out.writeheader()
+    async for order in cursor:
+        out.writerow(_export_row(order))
+        if buf.tell() >= 64 * 1024:
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate()
+    yield buf.getvalue()
+
+async def _export_ndjson(cursor):
+    chunk = []
+    async for order in cursor:
+        chunk.append(json.dumps(order, default=str))
+        if len(chunk) >= 500:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+    if chunk:
+        yield "\n".join(chunk) + "\n"
+
+@api_router.get("/admin/orders/export", dependencies=[Depends(require_admin_token)])
+async def export_admin_orders(format: str = "csv", start: Optional[str] = None, end: Optional[str] = None, archived: bool = False):
+    """Stream orders for accounting straight from a Mongo cursor (no ID images)"""
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    q = {}
+    if start or end:
+        # created_at is stored as an ISO-8601 string, so range compares are lexicographic
+        q["created_at"] = {k: v for k, v in (("$gte", start), ("$lt", end)) if v}
+    collection = reader(ARCHIVE_COLLECTION if archived else "delivery_orders", "admin")
+    cursor = collection.find(q, EXPORT_PROJECTION).sort("created_at", 1).batch_size(1000)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    if format == "csv":
+        body, media_type = _export_csv(cursor), "text/csv"
+    else:
+        body, media_type = _export_ndjson(cursor), "application/x-ndjson"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="orders-{stamp}.{format}"'})
+
+# ---- Bulk catalog import ----
+# CSV or NDJSON files are parsed row by row from the (disk-spooled) upload, validated
+# against ProductCreate in chunks and upserted with one unordered bulk_write per chunk,
+# keyed on sku when present and name otherwise. Memory is bounded by the chunk size.
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_ERRORS = 200
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', str(100 * 1024 * 1024)))
+
+def _import_rows(fileobj, fmt):
+    """Yield (line_number, row_dict_or_error) from a binary file object."""
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    try:
+        if fmt == "csv":
+            rows = csv.DictReader(text)
+            for row in rows:
+                row = {k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k}
+                row = {k: v for k, v in row.items() if v not in ("", None)}
+                if isinstance(row.get("variants"), str):
+                    try:
+                        row["variants"] = json.loads(row["variants"])
+                    except ValueError:
+                        yield rows.line_num, "variants must be a JSON list"
+                        continue
+                yield rows.line_num, row
+        else:
+            for line_num, line in enumerate(text, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_num, json.loads(line)
+                except ValueError as e:
+                    yield line_num, f"Invalid JSON: {e}"
+    finally:
+        text.detach()
+
+def _import_batches(fileobj, fmt, size):
+    batch = []
+    for item in _import_rows(fileobj, fmt):
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def import_products(fileobj, fmt, chunk_size=IMPORT_CHUNK_SIZE):
+    """Async generator of progress dicts; the last one has "done": True."""
+    batches = _import_batches(fileobj, fmt, chunk_size)
+    totals = {"rows": 0, "valid": 0, "inserted": 0, "updated": 0, "error_count": 0}
+    errors = []
+    try:
+        while True:
+            # Parsing touches the spooled file, so pull each chunk in a worker thread
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            ops = {}
+            now = datetime.now(timezone.utc).isoformat()
+            for line_num, row in batch:
+                totals["rows"] += 1
+                try:
+                    if isinstance(row, str):
+                        raise ValueError(row)
+                    product = ProductCreate.model_validate(row)
+                except (ValueError, ValidationError) as e:
+                    totals["error_count"] += 1
+                    if len(errors) < IMPORT_MAX_ERRORS:
+                        message = e.errors()[0] if isinstance(e, ValidationError) else str(e)
+                        errors.append({"line": line_num, "error": str(message)})
+                    continue
+                doc = product.model_dump(exclude_unset=True)
+                key = {"sku": product.sku} if product.sku else {"name": product.name}
+                # Last row wins when a chunk repeats a key, so one upsert per product
+                ops[tuple(key.items())] = UpdateOne(key, {"$set": doc, "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": now}}, upsert=True)
+            totals["valid"] += len(ops)
+            if ops:
+                res = await db.products.bulk_write(list(ops.values()), ordered=False)
+                totals["inserted"] += res.upserted_count
+                totals["updated"] += res.modified_count
+            yield {**totals, "done": False}
+    finally:
+        # Chunks already written must show up even if the client disconnects mid-import
+        invalidate_catalog()
+    yield {**totals, "errors": errors, "done": True}
+
+@api_router.post("/admin/products/import", dependencies=[Depends(require_admin_token)])
+async def admin_import_products(request: Request, format: Optional[str] = None):
+    """Stream-import a CSV or NDJSON catalog sent as the raw request body; responds with
+    NDJSON progress lines. The body is spooled to a temp file as it arrives (up to
+    IMPORT_MAX_BYTES), so memory use does not depend on the file size."""
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    too_large = HTTPException(status_code=413, detail=f"Import must be under {IMPORT_MAX_BYTES // (1024 * 1024)}MB")
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > IMPORT_MAX_BYTES:
+        raise too_large
+    spool = tempfile.TemporaryFile()
+    try:
+        async for chunk in request.stream():
+            if spool.tell() + len(chunk) > IMPORT_MAX_BYTES:
+                raise too_large
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    async def progress():
+        updates = import_products(spool, fmt)
+        try:
+            async for update in updates:
+                yield json.dumps(update) + "\n"
+        finally:
+            await updates.aclose()
+            spool.close()
+    return StreamingResponse(progress(), media_type="application/x-ndjson")
+
+# ---- Sales reporting rollups ----
+# Counters live in db.report_rollups as one document per (dim, key), e.g.
+# ("day", "2026-02-14"), ("tier", "0-10mi"), ("category", "Glass"), ("product", <id>)
+# plus a single ("all", "all") totals row. Order events $inc them in place so
+# /api/admin/reports never touches delivery_orders.
+#
+# A rebuild scans the whole history in the background while orders keep changing,
+# so every event is also journalled as (order_id, rev, deltas), rev being the
+# order's rollup_rev after the write. The rebuild replays the entries its scan did
+# not see; the ("all", "all") row keeps the ids of recent events so the replay can
+# skip those that already landed in the freshly swapped-in collection.
+ROLLUP_ORDER_PROJECTION = {"_id": 0, "id_image": 0, "address": 0}
+ROLLUP_JOURNAL_TTL_SECONDS = 7 * 86400
+ROLLUP_RECENT_EVENTS = 1000
+ROLLUP_REBUILD_STALE_SECONDS = 600
+ROLLUP_REPLAY_SETTLE_SECONDS = 5
+
+def _rollup_day(order):
+    created = order.get("created_at")
+    if isinstance(created, datetime):
+        return created.astimezone(timezone.utc).date().isoformat()
+    return str(created or "")[:10] or "unknown"
+
+def _rollup_field(name):
+    # Status strings come from clients; keep them safe as nested field names
+    return str(name or "unknown").replace(".", "_").replace("$", "_")
+
+def rollup_deltas(order, catalog, created=False, paid=False, status_from=None, status_to=None, into=None):
+    """Compute counter deltas for one order event as {(dim, key): {"inc": {...}, "set": {...}}}."""
+    deltas = into if into is not None else {}
+    def bump(dim, key, label=None, **fields):
+        entry = deltas.setdefault((dim, str(key or "unknown")), {"inc": {}, "set": {}})
+        for f, v in fields.items():
+            entry["inc"][f] = entry["inc"].get(f, 0) + v
+        if label:
+            entry["set"]["label"] = label
+    order_keys = [("all", "all"), ("day", _rollup_day(order)), ("tier", order.get("tier"))]
+    for dim, key in order_keys:
+        fields = {}
+        if created:
+            fields.update(orders=1, gross=order.get("total", 0))
+        if paid:
+            fields.update(paid_orders=1, revenue=order.get("total", 0), delivery_fees=order.get("delivery_fee", 0))
+        if status_from != status_to:
+            if status_from:
+                fields[f"status.{_rollup_field(status_from)}"] = -1
+            if status_to:
+                fields[f"status.{_rollup_field(status_to)}"] = 1
+        if fields:
+            bump(dim, key, **fields)
+    if created or paid:
+        for it in order.get("items", []):
+            p = it if it.get("unit_price") is not None else catalog.get(it.get("product_id"), {})
+            qty = it.get("quantity", 1)
+            line = round((p.get("unit_price") or p.get("price") or 0) * qty, 2)
+            fields = {"quantity": qty, "item_gross": line} if created else {}
+            if paid:
+                fields.update(paid_quantity=qty, item_revenue=line)
+            bump("category", p.get("category") or "Uncategorized", **fields)
+            bump("product", it.get("product_id"), label=p.get("name"), **fields)
+    return deltas
+
+async def rollup_catalog(items):
+    """Catalog lookup for line items without an order-time snapshot (legacy orders)."""
+    ids = list({i.get("product_id") for i in items if i.get("unit_price") is None})
+    if not ids:
+        return {}
+    found = await db.products.find({"id": {"$in": ids}}, LINE_ITEM_PROJECTION).to_list(800)
+    return {p['id']: p for p in found}
+
+def _rollup_ops(deltas, events=()):
+    now = datetime.now(timezone.utc).isoformat()
+    ops = []
+    for (dim, key), d in deltas.items():
+        if not d["inc"]:
+            continue
+        update = {"$inc": d["inc"], "$set": {**d["set"], "updated_at": now}}
+        if events and dim == "all":
+            update["$push"] = {"events": {"$each": list(events), "$slice": -ROLLUP_RECENT_EVENTS}}
+        ops.append(UpdateOne({"dim": dim, "key": key}, update, upsert=True))
+    return ops
+
+def _merge_deltas(into, deltas):
+    for k, d in deltas.items():
+        entry = into.setdefault(k, {"inc": {}, "set": {}})
+        for f, v in d["inc"].items():
+            entry["inc"][f] = entry["inc"].get(f, 0) + v
+        entry["set"].update(d["set"])
+    return into
+
+def _journal_entry(order_id, rev, deltas, at):
+    # Field names like "status.pending" are kept as [name, value] pairs, not as keys
+    return {"order_id": order_id, "rev": rev, "event": f"{order_id}:{rev}", "at": at, "deltas": [
+        {"dim": dim, "key": key, "inc": list(d["inc"].items()), "set": d["set"]}
+        for (dim, key), d in deltas.items() if d["inc"]
+    ]}
+
+def _journal_deltas(entry):
+    return {(r["dim"], r["key"]): {"inc": dict(r["inc"]), "set": r["set"]} for r in entry["deltas"]}
+
+async def apply_rollups(events):
+    """Apply [(order_id, rev, deltas)] order events with one unordered bulk_write and journal
+    them for a concurrent rebuild; reporting must never fail an order."""
+    events = [e for e in events if any(d["inc"] for d in e[2].values())]
+    if not events:
+        return
+    merged = {}
+    for _, _, deltas in events:
+        _merge_deltas(merged, deltas)
+    try:
+        await writer("report_rollups", "analytics").bulk_write(_rollup_ops(merged, [f"{o}:{r}" for o, r, _ in events]), ordered=False)
+        # Journalled only after the live write: the rebuild's replay relies on that order
+        now = datetime.now(timezone.utc)
+        await writer("report_rollups_journal", "analytics").insert_many([_journal_entry(o, r, d, now) for o, r, d in events], ordered=False)
+    except Exception as e:
+        logger.warning("Rollup update failed: %s", e)
+
+async def _replay_rollup_journal(since, seen):
+    """Apply journalled events newer than the scan saw that are not already in report_rollups."""
+    entries = await db.report_rollups_journal.find({"at": {"$gte": since}}, {"_id": 0}).to_list(None)
+    # Read after the journal: every entry above has finished its live write by now
+    totals = await db.report_rollups.find_one({"dim": "all", "key": "all"}, {"events": 1}) or {}
+    landed = set(totals.get("events") or [])
+    deltas, events = {}, []
+    for entry in entries:
+        if entry["rev"] <= seen.get(entry["order_id"], 0) or entry["event"] in landed:
+            continue
+        _merge_deltas(deltas, _journal_deltas(entry))
+        events.append(entry["event"])
+    ops = _rollup_ops(deltas, events)
+    if ops:
+        await db.report_rollups.bulk_write(ops, ordered=False)
+    return len(events)
+
+async def rebuild_rollups(run_id):
+    """Recompute every rollup from hot and archived orders into a per-run scratch collection,
+    swap it in, then replay the journalled events the scan missed."""
+    runs = db.report_rollups_rebuilds
+    # Journal entries this far back may describe writes a lagging secondary had not shown the scan yet
+    since = datetime.now(timezone.utc) - timedelta(seconds=max(MAX_STALENESS_SECONDS, 0) + 60)
+    products = await reader("products", "admin").find({}, LINE_ITEM_PROJECTION).to_list(None)
+    catalog = {p['id']: p for p in products}
+    deltas = {}
+    seen = {}  # order id -> rollup_rev the scan counted
+    for collection in (reader("delivery_orders", "admin"), reader(ARCHIVE_COLLECTION, "admin")):
+        async for order in collection.find({}, ROLLUP_ORDER_PROJECTION):
+            if order["id"] in seen:
+                continue  # archived mid-scan, or left behind by an interrupted archival batch
+            seen[order["id"]] = order.get("rollup_rev", 0)
+            rollup_deltas(order, catalog, created=True, paid=order.get("payment_status") == "completed", status_to=order.get("status"), into=deltas)
+            if len(seen) % 1000 == 0:
+                await runs.update_one({"_id": run_id}, {"$set": {"heartbeat_at": datetime.now(timezone.utc), "orders_scanned": len(seen)}})
+    scratch = db[f"report_rollups_rebuild_{run_id}"]
+    try:
+        await scratch.create_index([("dim", 1), ("key", 1)], unique=True)
+        ops = _rollup_ops(deltas)
+        for i in range(0, len(ops), 1000):
+            await scratch.bulk_write(ops[i:i + 1000], ordered=False)
+        if ops:
+            await scratch.rename("report_rollups", dropTarget=True)
+        else:
+            await db.report_rollups.delete_many({})
+    finally:
+        await scratch.drop()  # no-op once renamed
+    # Events whose live write hit the old collection just before the swap may not be journalled yet
+    await asyncio.sleep(ROLLUP_REPLAY_SETTLE_SECONDS)
+    replayed = await _replay_rollup_journal(since, seen)
+    return {"orders_scanned": len(seen), "rows": len(ops), "events_replayed": replayed}
+
+async def _run_rollup_rebuild(run_id):
+    runs = db.report_rollups_rebuilds
+    try:
+        result = await rebuild_rollups(run_id)
+    except Exception as e:
+        logger.error("Rollup rebuild %s failed: %s", run_id, e)
+        await runs.update_one({"_id": run_id}, {"$set": {"state": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc)}})
+    else:
+        logger.info("Rollup rebuild %s done: %s", run_id, result)
+        await runs.update_one({"_id": run_id}, {"$set": {"state": "done", **result, "finished_at": datetime.now(timezone.utc)}})
+
+async def start_rollup_rebuild():
+    """Claim the single rebuild slot (a partial unique index on state=running) and start the job."""
+    runs = db.report_rollups_rebuilds
+    now = datetime.now(timezone.utc)
+    # A worker that died mid-rebuild stops heartbeating; free its slot
+    await runs.update_many(
+        {"state": "running", "heartbeat_at": {"$lt": now - timedelta(seconds=ROLLUP_REBUILD_STALE_SECONDS)}},
+        {"$set": {"state": "failed", "error": "abandoned", "finished_at": now}},
+    )
+    run_id = uuid.uuid4().hex
+    try:
+        await runs.insert_one({"_id": run_id, "state": "running", "started_at": now, "heartbeat_at": now})
+    except DuplicateKeyError:
+        running = await runs.find_one({"state": "running"}, {"_id": 1})
+        raise HTTPException(status_code=409, detail=f"Rollup rebuild {running['_id'] if running else ''} already running")
+    app.state.rollup_rebuild_task = asyncio.create_task(_run_rollup_rebuild(run_id))
+    return run_id
+
+@api_router.get("/admin/reports")
+async def get_admin_reports(dim: str = "day", start: Optional[str] = None, end: Optional[str] = None, limit: int = 366):
+    """Serve precomputed sales rollups for the dispatcher dashboards"""
+    if dim not in ("day", "tier", "category", "product"):
+        raise HTTPException(status_code=400, detail="dim must be one of day, tier, category, product")
+    q = {"dim": dim}
+    if start or end:
+        q["key"] = {k: v for k, v in (("$gte", start), ("$lte", end)) if v}
+    rows = await reader("report_rollups", "admin").find(q, {"_id": 0, "dim": 0}).sort("key", 1).to_list(max(1, min(limit, 5000)))
+    totals = await reader("report_rollups", "admin").find_one({"dim": "all", "key": "all"}, {"_id": 0, "dim": 0, "key": 0, "events": 0})
+    return {"dim": dim, "rows": rows, "count": len(rows), "totals": totals or {}}
+
+@api_router.post("/admin/reports/rebuild", status_code=202, dependencies=[Depends(require_admin_token)])
+async def admin_rebuild_reports():
+    """Start backfilling rollups from the full order history; poll the returned run"""
+    run_id = await start_rollup_rebuild()
+    return {"ok": True, "run_id": run_id, "state": "running"}
+
+@api_router.get("/admin/reports/rebuild/{run_id}", dependencies=[Depends(require_admin_token)])
+async def admin_rebuild_status(run_id: str):
+    run = await db.report_rollups_rebuilds.find_one({"_id": run_id})
+    if not run:
+        raise HTTPException(status_code=404, detail="Rebuild not found")
+    return {"run_id": run.pop("_id"), **run}
 
 @api_router.post("/admin/seed-accessories")
 async def seed_accessories():
@@ -441,8 +2254,135 @@ async def seed_n2o():
             inserted += 1
     return {"ok": True, "inserted": inserted}
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# ---- Logging ----
+# Records are stamped with request context (trace id, method, path) on the calling thread
+# and handed to a bounded queue; a QueueListener thread does the JSON formatting and the
+# stderr write. A full queue drops and counts records instead of blocking, and access logs
+# give way first once the queue passes ACCESS_LOG_SHED_AT. Access logs are sampled per
+# route (ACCESS_LOG_SAMPLING="/api/health=0,/api/products=0.1", ACCESS_LOG_SAMPLE_RATE for
+# the rest); 5xx and slow requests are always logged. Counters: /api/admin/logging.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+ACCESS_LOG_SHED_AT = 0.8
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get('ACCESS_LOG_SAMPLE_RATE', '1.0'))
+ACCESS_LOG_SAMPLING = {
+    route.strip(): float(rate)
+    for route, _, rate in (part.partition("=") for part in os.environ.get('ACCESS_LOG_SAMPLING', '/api/health=0,/api/ready=0').split(","))
+    if rate
+}
+ACCESS_LOG_SLOW_MS = float(os.environ.get('ACCESS_LOG_SLOW_MS', '1000'))
+
+_log_request = contextvars.ContextVar("log_request", default=None)
+log_stats = {"dropped": Counter(), "access_logged": 0, "access_sampled_out": 0}
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "trace_id", "span_id", "request"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname, "logger": record.name, "msg": record.getMessage(),
+        }
+        for key in ("trace_id", "span_id", "request"):
+            if getattr(record, key, None):
+                entry[key] = getattr(record, key)
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The listener thread has no request context, so capture it here; message
+        # args are merged now in case they are mutated before the record is written
+        record.msg, record.args = record.getMessage(), None
+        record.trace_id = current_trace_id()
+        record.span_id = _current_span.get()
+        record.request = _log_request.get()
+        return record
+
+    def enqueue(self, record):
+        if record.name == "xplicit.access" and self.queue.qsize() >= self.queue.maxsize * ACCESS_LOG_SHED_AT:
+            log_stats["dropped"]["access"] += 1
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_stats["dropped"][record.levelname.lower()] += 1
+
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_output = logging.StreamHandler(sys.stderr)
+_log_output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+
+def stop_logging():
+    atexit.unregister(stop_logging)
+    try:
+        log_listener.stop()  # drains whatever is queued
+    except queue.Full:
+        pass
+
+def configure_logging():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(ContextQueueHandler(_log_queue))
+    root.setLevel(LOG_LEVEL)
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+    # The sampled access log below replaces uvicorn's unconditional per-request line
+    logging.getLogger("uvicorn.access").disabled = True
+    log_listener.start()
+    atexit.register(stop_logging)
+
+configure_logging()
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("xplicit.access")
+
+class AccessLogMiddleware:
+    def __init__(self, app, sample_rate, route_rates, slow_ms):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.route_rates = route_rates
+        self.slow_ms = slow_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = _log_request.set({"method": scope["method"], "path": scope["path"]})
+        status = 500
+
+        async def logged_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, logged_send)
+        finally:
+            _log_request.reset(token)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            route = getattr(scope.get("route"), "path", None) or scope["path"]
+            rate = self.route_rates.get(route, self.sample_rate)
+            if status >= 500 or elapsed_ms >= self.slow_ms or random.random() < rate:
+                log_stats["access_logged"] += 1
+                access_logger.info("%s %s %s", scope["method"], route, status, extra={
+                    "method": scope["method"], "route": route, "path": scope["path"], "status": status,
+                    "duration_ms": round(elapsed_ms, 2), "sample_rate": rate,
+                })
+            else:
+                log_stats["access_sampled_out"] += 1
+
+@api_router.get("/admin/logging")
+async def logging_stats():
+    return {
+        "queue_depth": _log_queue.qsize(), "queue_size": LOG_QUEUE_SIZE, "dropped": dict(log_stats["dropped"]),
+        "access_logged": log_stats["access_logged"], "access_sampled_out": log_stats["access_sampled_out"],
+        "access_sampling": {"default": ACCESS_LOG_SAMPLE_RATE, **ACCESS_LOG_SAMPLING},
+    }
 
 @app.on_event("startup")
 async def create_indexes():
@@ -450,11 +2390,50 @@ async def create_indexes():
         await db.products.create_index("id", unique=True)
         await db.products.create_index([("category", 1), ("brand", 1)])
         await db.products.create_index("name", unique=False)
+        await db.products.create_index("sku", unique=True, partialFilterExpression={"sku": {"$type": "string"}})
         await db.waitlist.create_index("email", unique=True)
         await db.waitlist.create_index([("created_at", -1)])
         await db.delivery_orders.create_index([("created_at", -1)])
+        await db.report_rollups.create_index([("dim", 1), ("key", 1)], unique=True)
+        await db.report_rollups_journal.create_index("at", expireAfterSeconds=ROLLUP_JOURNAL_TTL_SECONDS)
+        await db.report_rollups_rebuilds.create_index("state", unique=True, partialFilterExpression={"state": "running"})
+        await db.delivery_orders.create_index("id", unique=True)
+        await db.delivery_orders.create_index([("status", 1), ("created_at", 1)])
+        await db[ARCHIVE_COLLECTION].create_index("id", unique=True)
+        await db[ARCHIVE_COLLECTION].create_index([("created_at", -1)])
+        await db.id_uploads.create_index("id", unique=True)
+        await db.id_uploads.create_index("created_at", expireAfterSeconds=ID_UPLOAD_TTL_SECONDS)
     except Exception as e:
-        logger.warning(f"Index creation issue: {e}")
+        logger.warning("Index creation issue: %s", e)
+
+@app.on_event("startup")
+async def prepare_frontend():
+    if SERVE_FRONTEND:
+        try:
+            written = await asyncio.to_thread(precompress_frontend, FRONTEND_BUILD_DIR)
+        except OSError as e:
+            # Read-only build dirs are common in containers; assets missing a sidecar go out uncompressed
+            logger.warning("Frontend precompression skipped, serving uncompressed assets: %s", e)
+            return
+        logger.info("Serving frontend from %s (%d compressed variants written)", FRONTEND_BUILD_DIR, written)
+
+@app.on_event("startup")
+async def start_health_prober():
+    await probe_dependencies()
+    app.state.health_task = asyncio.create_task(health_probe_loop())
+
+@app.on_event("startup")
+async def start_archival():
+    app.state.archival_task = asyncio.create_task(archival_loop())
+
+@app.on_event("startup")
+async def start_waitlist():
+    try:
+        warmed = await warm_waitlist_bloom()
+        logger.info("Waitlist Bloom filter warmed with %d emails", warmed)
+    except Exception as e:
+        logger.warning("Waitlist Bloom warm-up failed: %s", e)
+    app.state.waitlist_task = asyncio.create_task(waitlist_flush_loop())
 
 @api_router.post("/seed")
 async def seed_products():
@@ -605,15 +2584,242 @@ async def seed_prerolls():
             inserted += 1
     return {"ok": True, "inserted": inserted}
 
+# ---- Production frontend ----
+# When a CRA production build is present (FRONTEND_BUILD_DIR, default ../frontend/build)
+# the backend serves it directly: /static/* assets are content-hashed by the build, so
+# they get immutable cache headers and are served from .br/.gz sidecars generated at
+# startup; every other non-API path gets index.html with the catalog inlined as
+# window.__INITIAL_PRODUCTS__ so first paint needs no API round-trip.
+FRONTEND_BUILD_DIR = Path(os.environ.get('FRONTEND_BUILD_DIR', str(ROOT_DIR.parent / 'frontend' / 'build'))).resolve()
+SERVE_FRONTEND = os.environ.get('SERVE_FRONTEND', '1') != '0' and (FRONTEND_BUILD_DIR / 'index.html').is_file()
+PRECOMPRESS_EXTENSIONS = {".js", ".css", ".map", ".json", ".svg", ".txt", ".html", ".ico"}
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+_index_cache = {"body": None, "at": 0.0}
+
+def precompress_frontend(build_dir):
+    """Write .gz (and .br when brotli is installed) next to each compressible asset."""
+    written = 0
+    for path in build_dir.rglob("*"):
+        if not path.is_file() or path.suffix not in PRECOMPRESS_EXTENSIONS:
+            continue
+        data = None
+        for suffix, compress in ((".gz", lambda b: gzip.compress(b, compresslevel=9)), (".br", brotli and (lambda b: brotli.compress(b, quality=11)))):
+            target = path.with_name(path.name + suffix)
+            if not compress or (target.exists() and target.stat().st_mtime >= path.stat().st_mtime):
+                continue
+            data = data if data is not None else path.read_bytes()
+            # Write aside and rename, so a worker starting alongside never sees a partial file
+            fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(compress(data))
+                os.replace(tmp, target)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp)
+                raise
+            written += 1
+    return written
+
+def _safe_build_path(relative):
+    path = (FRONTEND_BUILD_DIR / relative).resolve()
+    if FRONTEND_BUILD_DIR not in path.parents or not path.is_file():
+        return None
+    return path
+
+def _asset_response(request: Request, path: Path, cache_control: str):
+    headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    sidecars = {"br": path.with_name(path.name + ".br"), "gzip": path.with_name(path.name + ".gz")}
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"), {enc for enc, p in sidecars.items() if p.is_file()})
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return FileResponse(sidecars[encoding], media_type=media_type, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+async def render_index():
+    if _index_cache["body"] is not None and time.monotonic() - _index_cache["at"] < CATALOG_TTL_SECONDS:
+        return _index_cache["body"]
+    template = await asyncio.to_thread((FRONTEND_BUILD_DIR / "index.html").read_bytes)
+    try:
+        products = await db_call(reader("products", "catalog").find({}, {"_id": 0}).max_time_ms(DB_MAX_TIME_MS).to_list(800))
+        payload = product_list_adapter.dump_json(product_list_adapter.validate_python(products))
+    except DatabaseUnavailable:
+        if _catalog_snapshot["products"] is None:
+            return template
+        payload = product_list_adapter.dump_json(_catalog_snapshot["products"])
+    # \u003c keeps "</script>" or "<!--" inside product text from ending the inline script
+    script = b"<script>window.__INITIAL_PRODUCTS__=" + payload.replace(b"<", b"\\u003c") + b";</script>"
+    body = template.replace(b"</head>", script + b"</head>", 1)
+    _index_cache.update(body=body, at=time.monotonic())
+    return body
+
+async def serve_static_asset(request: Request, asset_path: str):
+    path = _safe_build_path(Path("static") / asset_path)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return _asset_response(request, path, IMMUTABLE_CACHE)
+
+async def serve_frontend(request: Request, full_path: str):
+    if full_path == "api" or full_path.startswith("api/"):
+        raise HTTPException(status_code=404, detail="Not found")
+    path = _safe_build_path(full_path) if full_path else None
+    if path is not None and path.name != "index.html":
+        return _asset_response(request, path, "public, max-age=3600")
+    return cached_json_response(request, await render_index(), media_type="text/html")
+
+# ---- Traffic capture ----
+# Opt-in (CAPTURE_SAMPLE_RATE > 0) ASGI middleware that samples requests into a JSONL
+# log for replay_traffic.py. Customer PII is replaced with fixed stand-ins of the same
+# shape, free-text notes with same-length filler, ID images with their size, and emails
+# with a keyed HMAC (CAPTURE_SECRET, random per process when unset) so repeat customers
+# still collide without the address being recoverable. Query parameters outside
+# CAPTURE_QUERY_KEYS keep only their names.
+# Lines are written by a background thread through a bounded queue; overflow is dropped.
+CAPTURE_SAMPLE_RATE = float(os.environ.get('CAPTURE_SAMPLE_RATE', '0'))
+CAPTURE_PATH = os.environ.get('CAPTURE_PATH', '/tmp/xplicit-capture.jsonl')
+CAPTURE_SECRET = os.environ.get('CAPTURE_SECRET', '')
+CAPTURE_MAX_BODY = 32 * 1024 * 1024
+CAPTURE_EXCLUDE_PREFIXES = ("/api/admin/profile",)
+CAPTURE_QUERY_KEYS = {"format", "start", "end", "limit", "dim", "status", "seconds"}
+PII_STAND_INS = {
+    "name": "Replay User", "customer_name": "Replay User", "phone": "5125550100", "address1": "100 Replay St",
+    "address2": None, "dob": "1990-01-01", "source_id": "cnon:card-nonce-ok",
+}
+FREE_TEXT_FIELDS = {"dispatcher_note", "note", "notes", "comment", "comments", "message"}
+
+def redact(value, secret, key=None):
+    if isinstance(value, dict):
+        return {k: redact(v, secret, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v, secret) for v in value]
+    if key == "id_image" and isinstance(value, str):
+        return {"__image_bytes__": len(value)}
+    if key in ("email", "customer_email") and isinstance(value, str):
+        return f"{hmac.new(secret, value.lower().encode(), hashlib.sha256).hexdigest()[:16]}@example.com"
+    if key in FREE_TEXT_FIELDS and isinstance(value, str):
+        return "x" * len(value)
+    if key in PII_STAND_INS and value is not None:
+        return PII_STAND_INS[key]
+    return value
+
+def redact_query(query):
+    pairs = parse_qsl(query, keep_blank_values=True)
+    return urlencode([(k, v if k in CAPTURE_QUERY_KEYS else "redacted") for k, v in pairs])
+
+class TrafficCaptureMiddleware:
+    def __init__(self, app, sample_rate, path):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.secret = CAPTURE_SECRET.encode() or os.urandom(32)
+        self.queue = queue.Queue(maxsize=10000)
+        self.dropped = 0
+        threading.Thread(target=self._writer, args=(path,), name="traffic-capture", daemon=True).start()
+
+    def _writer(self, path):
+        with open(path, "a", encoding="utf-8") as f:
+            while True:
+                f.write(self.queue.get() + "\n")
+                if self.queue.empty():
+                    f.flush()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(CAPTURE_EXCLUDE_PREFIXES) or random.random() >= self.sample_rate:
+            return await self.app(scope, receive, send)
+        chunks, size, resp = [], 0, {"status": None, "body": b""}
+        multipart = dict(scope.get("headers") or []).get(b"content-type", b"").startswith(b"multipart/")
+        started_at = time.time()
+        started = time.perf_counter()
+
+        async def capture_receive():
+            nonlocal size
+            message = await receive()
+            if message["type"] == "http.request":
+                # Multipart uploads (ID photos) are only measured, never held
+                if size < CAPTURE_MAX_BODY and not multipart:
+                    chunks.append(message.get("body", b""))
+                size += len(message.get("body", b""))
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                resp["status"] = message["status"]
+            elif message["type"] == "http.response.body" and len(resp["body"]) < 4096:
+                resp["body"] += message.get("body", b"")
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            self._record(scope, b"".join(chunks), size, resp, started_at, time.perf_counter() - started)
+
+    def _record(self, scope, body, size, resp, started_at, elapsed):
+        entry = {
+            "ts": round(started_at, 4),
+            "method": scope["method"],
+            "path": scope["path"],
+            "route": getattr(scope.get("route"), "path", None),
+            "query": redact_query(scope.get("query_string", b"").decode("latin-1")),
+            "status": resp["status"],
+            "duration_ms": round(elapsed * 1000, 2),
+            "content_type": dict(scope.get("headers") or []).get(b"content-type", b"").decode("latin-1"),
+        }
+        if body:
+            try:
+                entry["json"] = redact(json.loads(body), self.secret)
+            except ValueError:
+                entry["body_bytes"] = size
+        elif size:
+            entry["body_bytes"] = size
+        try:
+            # Keep created order and upload ids so replays can map later calls onto the ones they create
+            created = json.loads(resp["body"])
+            for field, ref in (("order_id", "order_ref"), ("upload_id", "upload_ref")):
+                if created.get(field):
+                    entry[ref] = created[field]
+        except (ValueError, AttributeError):
+            pass
+        try:
+            self.queue.put_nowait(json.dumps(entry, separators=(",", ":")))
+        except queue.Full:
+            self.dropped += 1
+
 app.include_router(api_router)
+if SERVE_FRONTEND:
+    # Registered after the API so the SPA catch-all never shadows an API route
+    app.add_api_route("/static/{asset_path:path}", serve_static_asset, methods=["GET"], include_in_schema=False)
+    app.add_api_route("/{full_path:path}", serve_frontend, methods=["GET"], include_in_schema=False)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
+if CAPTURE_SAMPLE_RATE > 0:
+    app.add_middleware(TrafficCaptureMiddleware, sample_rate=CAPTURE_SAMPLE_RATE, path=CAPTURE_PATH)
+app.add_middleware(AccessLogMiddleware, sample_rate=ACCESS_LOG_SAMPLE_RATE, route_rates=ACCESS_LOG_SAMPLING, slow_ms=ACCESS_LOG_SLOW_MS)
+# Outermost, so the root span covers the other middleware too
+app.add_middleware(TracingMiddleware, exporter=trace_exporter, sample_rate=TRACE_SAMPLE_RATE, slow_ms=TRACE_SLOW_MS)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for name in ("health_task", "archival_task", "rollup_rebuild_task"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
+    # Let an in-progress waitlist flush finish rather than cancelling it mid-write
+    waitlist_task = getattr(app.state, "waitlist_task", None)
+    if waitlist_task:
+        _waitlist_stopping.set()
+        _waitlist_flush_event.set()
+        done, _ = await asyncio.wait({waitlist_task}, timeout=10)
+        if not done:
+            waitlist_task.cancel()
+    try:
+        await flush_waitlist()
+    except Exception as e:
+        logger.error("Final waitlist flush failed, %d signups not written: %s", len(_waitlist_buffer), e)
     client.close()
+    stop_logging()
@@ -4,7 +4,11 @@ Backend API tests for XplicitkreationZ - Testing cart persistence, ID upload, an
 import pytest
 import requests
 import os
+import sys
 import base64
+import json
+import time
+import uuid
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
 
@@ -20,6 +24,8 @@ class TestHealthEndpoints:
         assert response.status_code == 200
         data = response.json()
         assert data.get("status") == "ok"
+        assert "mongo" in data.get("dependencies", {})
+        assert data.get("db_breaker") == "closed"
         print("SUCCESS: API health check passed")
     
     def test_api_ready(self):
@@ -28,9 +34,244 @@ class TestHealthEndpoints:
         assert response.status_code == 200
         data = response.json()
         assert data.get("mongo") == True
+        assert data["dependencies"]["mongo"].get("p50_ms") is not None
         print("SUCCESS: API ready check passed - MongoDB connected")
 
 
+@pytest.fixture(scope="module")
+def server():
+    """The backend module imported in-process, for tests that need no running server"""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017/?replicaSet=rs0")
+    os.environ.setdefault("DB_NAME", "test_database")
+    return pytest.importorskip("server")
+
+
+def create_test_order(name="TEST_Payment_User"):
+    """Place a one-item delivery order and return its id"""
+    product = requests.get(f"{BASE_URL}/api/products").json()[0]
+    response = requests.post(f"{BASE_URL}/api/orders/delivery", json={
+        "items": [{"product_id": product["id"], "quantity": 1}],
+        "address": {"name": name, "phone": "5125551234", "address1": "123 Test St", "city": "Austin",
+                    "state": "TX", "zip": "78751", "dob": "1990-01-15", "email": "test@example.com"},
+        "id_image": TEST_ID_IMAGE_BASE64,
+    })
+    assert response.status_code == 200
+    return response.json()["order_id"]
+
+
+def admin_headers():
+    """X-Admin-Token header for the guarded admin endpoints; skips when no token is configured"""
+    token = os.environ.get("ADMIN_TOKEN")
+    if not token:
+        pytest.skip("ADMIN_TOKEN not set")
+    return {"X-Admin-Token": token}
+
+
+class TestReadRouting:
+    """Read preference and read concern of each route's collection handle (in-process, no server needed)"""
+    
+    def test_catalog_and_admin_read_secondaries(self, server):
+        """Test catalog and admin handles use secondaryPreferred with bounded staleness"""
+        from pymongo.read_preferences import SecondaryPreferred
+        for route in ("catalog", "admin"):
+            handle = server.reader("products", route)
+            assert isinstance(handle.read_preference, SecondaryPreferred)
+            assert handle.read_preference.max_staleness == server.MAX_STALENESS_SECONDS
+            assert handle.read_concern.level == "local"
+        print(f"SUCCESS: catalog/admin reads go to secondaries (max staleness {server.MAX_STALENESS_SECONDS}s)")
+    
+    def test_order_and_payment_reads_stay_on_primary(self, server):
+        """Test the primary route, plain db handles and write profiles read from the primary"""
+        from pymongo.read_preferences import Primary
+        handles = [
+            server.reader("delivery_orders", "primary"),
+            server.db.delivery_orders,
+            server.writer("delivery_orders", "orders"),
+            server.writer("delivery_orders", "payment"),
+        ]
+        for handle in handles:
+            assert isinstance(handle.read_preference, Primary)
+        print("SUCCESS: Order and payment lookups stay on the primary")
+
+
+class TestCircuitBreaker:
+    """Breaker state transitions (in-process, no server needed)"""
+    
+    def _opened(self, server):
+        breaker = server.CircuitBreaker(window=4, threshold=0.5, min_calls=4, slow_seconds=1.0, cooldown=0.05)
+        for ok in (True, True, False, False):
+            breaker.record(ok, 0.0)
+        assert breaker.state == "open"
+        return breaker
+    
+    def test_open_half_open_close(self, server):
+        """Test the breaker opens on failures, admits one trial after cooldown and closes on success"""
+        breaker = self._opened(server)
+        assert not breaker.allow()
+        time.sleep(0.06)
+        assert breaker.state == "half_open"
+        assert breaker.allow() and not breaker.allow()
+        breaker.record(True, 0.0, trial=True)
+        assert breaker.state == "closed" and not breaker.trial_in_flight
+        print("SUCCESS: closed -> open -> half-open -> closed")
+    
+    def test_failed_trial_reopens(self, server):
+        """Test a failed or slow trial restarts the cooldown"""
+        breaker = self._opened(server)
+        time.sleep(0.06)
+        assert breaker.allow()
+        breaker.record(True, 5.0, trial=True)
+        assert breaker.state == "open" and not breaker.trial_in_flight
+        print("SUCCESS: half-open -> open on a slow trial")
+    
+    def test_stale_completion_ignored(self, server):
+        """Test calls started before the breaker opened neither close it nor free the trial slot"""
+        breaker = self._opened(server)
+        opened_at = breaker.opened_at
+        breaker.record(True, 0.0)
+        breaker.record(False, 0.0)
+        assert breaker.opened_at == opened_at
+        time.sleep(0.06)
+        assert breaker.allow()
+        breaker.record(True, 0.0)
+        assert breaker.trial_in_flight and not breaker.allow()
+        assert breaker.state == "half_open"
+        print("SUCCESS: Stale completions leave the breaker untouched")
+
+
+class TestReadiness:
+    """/api/ready against stand-in dependency probes (in-process, no server needed)"""
+    
+    @pytest.fixture
+    def probes(self, server, monkeypatch):
+        """Stand-in mongo and geocoder probes that fail while their flag is False"""
+        from collections import deque
+        up = {"mongo": True, "geocoder": True}
+        def stand_in(name):
+            async def probe():
+                if not up[name]:
+                    raise RuntimeError(f"{name} down")
+            return probe
+        monkeypatch.setattr(server, "HEALTH_PROBES", {name: stand_in(name) for name in up})
+        monkeypatch.setattr(server, "_health_latencies", {name: deque(maxlen=server.HEALTH_WINDOW) for name in up})
+        monkeypatch.setattr(server, "dependency_health", {name: {"ok": None, "checks": 0, "errors": 0, "consecutive_failures": 0} for name in up})
+        return up
+    
+    def _ready(self, server, probe=True):
+        import asyncio
+        if probe:
+            asyncio.run(server.probe_dependencies())
+        result = asyncio.run(server.ready())
+        if hasattr(result, "status_code"):
+            return result.status_code, json.loads(result.body)
+        return 200, result
+    
+    def test_not_ready_while_starting(self, server, probes):
+        """Test readiness is 503 until the first probe has run"""
+        status, body = self._ready(server, probe=False)
+        assert status == 503 and body["status"] == "starting"
+        print("SUCCESS: Not ready before the first probe")
+    
+    def test_critical_failure_and_recovery(self, server, probes):
+        """Test a failing critical probe gives 503 and its recovery gives 200"""
+        probes["mongo"] = False
+        status, body = self._ready(server)
+        assert status == 503 and body["status"] == "unavailable"
+        assert body["error"] == "mongo down"
+        probes["mongo"] = True
+        status, body = self._ready(server)
+        assert status == 200 and body["status"] == "ready"
+        assert server.dependency_health["mongo"]["consecutive_failures"] == 0
+        print("SUCCESS: Readiness follows the critical probe down and back up")
+    
+    def test_non_critical_failure_degrades(self, server, probes):
+        """Test a failing geocoder keeps the instance in rotation as degraded"""
+        probes["geocoder"] = False
+        status, body = self._ready(server)
+        assert status == 200 and body["status"] == "degraded"
+        print("SUCCESS: Geocoder outage reported as degraded")
+
+
+class TestTrafficCapture:
+    """Capture redaction and replay rewriting (in-process, no server needed)"""
+    
+    def test_redact_removes_pii(self, server):
+        """Test PII, free text and ID images are replaced and emails are keyed hashes"""
+        body = {
+            "items": [{"product_id": "p1", "quantity": 1}],
+            "address": {"name": "Jane Roe", "phone": "5125551234", "address1": "1 Main St", "zip": "78751",
+                        "dob": "1990-05-01", "email": "Jane@Example.com"},
+            "id_image": TEST_ID_IMAGE_BASE64,
+            "dispatcher_note": "gate code 4411",
+        }
+        out = server.redact(body, b"secret")
+        assert out["address"]["name"] == "Replay User"
+        assert out["address"]["zip"] == "78751"
+        assert out["id_image"] == {"__image_bytes__": len(TEST_ID_IMAGE_BASE64)}
+        assert out["dispatcher_note"] == "x" * len("gate code 4411")
+        email = out["address"]["email"]
+        assert email.endswith("@example.com") and "jane" not in email
+        assert server.redact({"email": "jane@example.com"}, b"secret")["email"] == email
+        assert server.redact({"email": "jane@example.com"}, b"other")["email"] != email
+        print("SUCCESS: Capture redaction strips PII")
+    
+    def test_redact_query(self, server):
+        """Test only allow-listed query values survive"""
+        query = server.redact_query("format=csv&email=jane%40example.com&start=2024-01-01")
+        assert "jane" not in query
+        assert "format=csv" in query and "start=2024-01-01" in query and "email=redacted" in query
+        print("SUCCESS: Capture query string filtered")
+    
+    def test_replayer_rewrite(self, server):
+        """Test captured product and order ids are remapped onto the replay database"""
+        replay_traffic = pytest.importorskip("replay_traffic")
+        replayer = replay_traffic.Replayer(["local-1", "local-2"])
+        replayer.order_map["captured-order"] = "replayed-order"
+        path, payload = replayer.rewrite({"path": "/api/products/captured-p", "json": None})
+        assert path == "/api/products/local-1"
+        path, payload = replayer.rewrite({"path": "/api/orders/delivery", "json": {
+            "items": [{"product_id": "captured-p"}, {"product_id": "local-2"}], "id_image": {"__image_bytes__": 40},
+        }})
+        assert [i["product_id"] for i in payload["items"]] == ["local-1", "local-2"]
+        assert payload["id_image"].startswith("data:image/jpeg;base64,") and len(payload["id_image"]) == 40
+        path, payload = replayer.rewrite({"path": "/api/admin/orders/captured-order/status", "json": {"status": "dispatched"}})
+        assert path == "/api/admin/orders/replayed-order/status"
+        _, payload = replayer.rewrite({"path": "/api/payments/square", "json": {"order_id": "captured-order"}})
+        assert payload["order_id"] == "replayed-order"
+        replayer.upload_map["captured-upload"] = "replayed-upload"
+        _, payload = replayer.rewrite({"path": "/api/orders/delivery", "json": {"items": [], "id_upload": "captured-upload"}})
+        assert payload["id_upload"] == "replayed-upload"
+        print("SUCCESS: Replay rewrites product, order and upload ids")
+    
+    def test_replay_placeholder_upload(self, server):
+        """Test captured ID uploads replay as a decodable image of the captured size"""
+        replay_traffic = pytest.importorskip("replay_traffic")
+        body, content_type = replay_traffic.placeholder_upload(200_000)
+        assert len(body) == 200_000
+        assert content_type.startswith("multipart/form-data; boundary=")
+        image = body[body.index(b"\r\n\r\n") + 4:body.rindex(b"\r\n--")]
+        assert image[:3] == b"\xff\xd8\xff"
+        if server.Image is not None:
+            import io
+            assert server._prepare_id_image(io.BytesIO(image))[1] == "image/jpeg"
+        print("SUCCESS: Placeholder upload built")
+
+
+class TestDatabasePool:
+    """Mongo client pool and write profile reporting"""
+    
+    def test_db_pool_stats(self):
+        """Test pool checkout stats and write profiles are exposed"""
+        response = requests.get(f"{BASE_URL}/api/admin/db/pool")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["pool"]["max_pool_size"] > 0
+        assert "wait_p95_ms" in data["pool"]
+        assert data["write_profiles"]["payment"].get("w") == "majority"
+        print(f"SUCCESS: Pool peak checked out {data['pool']['peak_checked_out']} of {data['pool']['max_pool_size']}")
+
+
 class TestProductEndpoints:
     """Product CRUD endpoints"""
     
@@ -55,6 +296,40 @@ class TestProductEndpoints:
             data = response.json()
             assert data.get("id") == product_id
             print(f"SUCCESS: Got product {data.get('name')}")
+    
+    def test_products_etag_revalidation(self):
+        """Test catalog responses carry an ETag and revalidate with 304"""
+        response = requests.get(f"{BASE_URL}/api/products", headers={"Accept-Encoding": "br, gzip"})
+        assert response.status_code == 200
+        etag = response.headers.get("ETag")
+        assert etag
+        assert response.headers.get("Content-Encoding") in ("br", "gzip")
+        cached = requests.get(f"{BASE_URL}/api/products", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+        assert etag.startswith('W/"')
+        print(f"SUCCESS: Catalog served as {response.headers.get('Content-Encoding')} with ETag {etag}")
+    
+    def test_related_products(self):
+        """Test related products come from the server-side index"""
+        products = requests.get(f"{BASE_URL}/api/products").json()
+        product_id = products[0].get("id")
+        response = requests.get(f"{BASE_URL}/api/products/{product_id}/related", params={"limit": 4})
+        assert response.status_code == 200
+        related = response.json()
+        assert len(related) <= 4
+        assert all(p["id"] != product_id for p in related)
+        assert all("price" in p and "image_url" in p for p in related)
+        missing = requests.get(f"{BASE_URL}/api/products/TEST_missing_product/related")
+        assert missing.status_code == 404
+        print(f"SUCCESS: Got {len(related)} related products for {products[0].get('name')}")
+    
+    def test_related_products_for_new_product(self):
+        """Test a just-created product has related products on any worker"""
+        created = requests.post(f"{BASE_URL}/api/products", json={"name": f"TEST_Related {uuid.uuid4().hex[:8]}", "price": 9.99, "category": "Accessory"})
+        assert created.status_code == 200
+        response = requests.get(f"{BASE_URL}/api/products/{created.json()['id']}/related")
+        assert response.status_code == 200
+        print(f"SUCCESS: New product has {len(response.json())} related products")
 
 
 class TestDeliveryQuote:
@@ -109,6 +384,37 @@ class TestDeliveryQuote:
         print(f"SUCCESS: Low subtotal correctly rejected - {data.get('reason')}")
 
 
+class TestCartPricing:
+    """Server-side cart pricing endpoint tests"""
+    
+    def test_price_cart_with_quote(self):
+        """Test pricing a cart and quoting delivery in one request"""
+        products = requests.get(f"{BASE_URL}/api/products").json()
+        product = products[0]
+        response = requests.post(f"{BASE_URL}/api/cart/price", json={
+            "items": [{"product_id": product["id"], "quantity": 3}],
+            "zip": "78751"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["subtotal"] == round(product["price"] * 3, 2)
+        assert data["items"][0]["unit_price"] == product["price"]
+        assert data["quote"]["tier"] is not None
+        assert data["errors"] == []
+        print(f"SUCCESS: Cart priced at ${data['subtotal']} + ${data['quote']['fee']} delivery")
+    
+    def test_price_cart_invalid_product(self):
+        """Test unknown products are reported per item"""
+        response = requests.post(f"{BASE_URL}/api/cart/price", json={
+            "items": [{"product_id": "TEST_missing_product", "quantity": 1}]
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["valid"] == False
+        assert data["errors"][0]["product_id"] == "TEST_missing_product"
+        print("SUCCESS: Invalid product reported by cart pricing")
+
+
 class TestOrderWithIDImage:
     """Test order creation with ID image - Core feature test"""
     
@@ -209,6 +515,43 @@ class TestOrderWithIDImage:
         print(f"SUCCESS: Underage order correctly rejected - {data.get('detail')}")
 
 
+class TestIDUpload:
+    """Test multipart ID upload referenced from the order"""
+    
+    def test_upload_id_and_create_order(self):
+        """Test an uploaded ID can be used by reference when creating an order"""
+        png = base64.b64decode(TEST_ID_IMAGE_BASE64.split(",", 1)[1])
+        response = requests.post(f"{BASE_URL}/api/uploads/id", files={"file": ("id.png", png, "image/png")})
+        assert response.status_code == 200
+        upload = response.json()
+        assert upload.get("upload_id")
+        
+        product = requests.get(f"{BASE_URL}/api/products").json()[0]
+        order_data = {
+            "items": [{"product_id": product.get("id"), "quantity": 1}],
+            "address": {
+                "name": "TEST_Upload_User",
+                "phone": "5125551234",
+                "address1": "789 Test Blvd",
+                "city": "Austin",
+                "state": "TX",
+                "zip": "78751",
+                "dob": "1988-03-10",
+                "email": "upload@example.com"
+            },
+            "id_upload": upload["upload_id"]
+        }
+        response = requests.post(f"{BASE_URL}/api/orders/delivery", json=order_data)
+        assert response.status_code == 200
+        print(f"SUCCESS: Order {response.json().get('order_id')} created from upload {upload['upload_id']}")
+    
+    def test_upload_rejects_non_image(self):
+        """Test non-image uploads are refused"""
+        response = requests.post(f"{BASE_URL}/api/uploads/id", files={"file": ("id.txt", b"not an image", "text/plain")})
+        assert response.status_code == 415
+        print("SUCCESS: Non-image ID upload rejected")
+
+
 class TestAdminOrdersEndpoint:
     """Test admin orders endpoint - Dispatcher Console"""
     
@@ -236,6 +579,26 @@ class TestAdminOrdersEndpoint:
             assert "id_image" in order or order.get("id_image") is None
             print("SUCCESS: Order structure is correct with id_image field")
     
+    def test_admin_orders_not_cacheable(self):
+        """Test the PII-bearing admin feed is marked private and no-store"""
+        response = requests.get(f"{BASE_URL}/api/admin/orders")
+        assert response.status_code == 200
+        assert response.headers.get("Cache-Control") == "private, no-store"
+        print("SUCCESS: Admin orders served with Cache-Control: private, no-store")
+    
+    def test_private_bodies_bypass_compression_cache(self, server):
+        """Test private responses are compressed without entering the shared LRU (in-process)"""
+        from starlette.requests import Request
+        request = Request({"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", b"gzip")]})
+        body = json.dumps([{"id": uuid.uuid4().hex, "note": "x" * 4096}]).encode()
+        before = len(server._compress_cache)
+        response = server.cached_json_response(request, body, private=True)
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert len(server._compress_cache) == before
+        server.cached_json_response(request, body)
+        assert len(server._compress_cache) == before + 1
+        print("SUCCESS: Private bodies skip the compression cache")
+    
     def test_order_has_id_image_field(self):
         """Test that orders include id_image field for verification"""
         # First create an order with ID image
@@ -274,6 +637,19 @@ class TestAdminOrdersEndpoint:
         assert our_order.get("id_image") is not None
         assert our_order.get("id_image").startswith("data:image")
         print(f"SUCCESS: Order {order_id} has id_image stored correctly")
+    
+    def test_order_line_items_hydrated(self):
+        """Test admin feed line items carry product name and unit price"""
+        response = requests.get(f"{BASE_URL}/api/admin/orders")
+        assert response.status_code == 200
+        orders = response.json().get("orders", [])
+        items = [it for o in orders for it in o.get("items", [])]
+        if not items:
+            pytest.skip("No order line items to check")
+        item = items[0]
+        assert "name" in item
+        assert "unit_price" in item
+        print(f"SUCCESS: Line item hydrated - {item.get('name')} @ ${item.get('unit_price')}")
 
 
 class TestOrderStatusUpdate:
@@ -299,6 +675,249 @@ class TestOrderStatusUpdate:
             print(f"SUCCESS: Order {order_id} status updated to confirmed")
         else:
             pytest.skip("No orders available for status update test")
+    
+    def test_bulk_update_order_status(self):
+        """Test updating several orders in one request with per-order results"""
+        orders = requests.get(f"{BASE_URL}/api/admin/orders").json().get("orders", [])
+        if not orders:
+            pytest.skip("No orders available for bulk status update test")
+        updates = [{"order_id": o["id"], "status": o.get("status", "pending")} for o in orders[:3]]
+        updates.append({"order_id": "TEST_missing_order", "status": "dispatched"})
+        response = requests.post(f"{BASE_URL}/api/admin/orders/status/bulk", json={"updates": updates})
+        assert response.status_code == 200
+        data = response.json()
+        assert data.get("updated") == len(updates) - 1
+        results = {r["order_id"]: r for r in data.get("results", [])}
+        assert results["TEST_missing_order"]["ok"] == False
+        print(f"SUCCESS: Bulk updated {data.get('updated')} orders in one request")
+
+
+class TestAdminReports:
+    """Test materialized sales rollups for the reporting dashboards"""
+    
+    def test_get_daily_report(self):
+        """Test daily rollups are served with totals"""
+        response = requests.get(f"{BASE_URL}/api/admin/reports", params={"dim": "day"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data.get("dim") == "day"
+        assert isinstance(data.get("rows"), list)
+        assert "totals" in data
+        print(f"SUCCESS: Got {data.get('count')} daily rollup rows")
+    
+    def test_invalid_dimension_rejected(self):
+        """Test unknown report dimensions return 400"""
+        response = requests.get(f"{BASE_URL}/api/admin/reports", params={"dim": "color"})
+        assert response.status_code == 400
+        print("SUCCESS: Invalid report dimension rejected")
+    
+    def test_new_order_updates_daily_counters(self):
+        """Test placing an order bumps today's rollup and the totals"""
+        def counters():
+            data = requests.get(f"{BASE_URL}/api/admin/reports", params={"dim": "day", "start": today, "end": today}).json()
+            row = data["rows"][0] if data["rows"] else {}
+            return row.get("orders", 0), data["totals"].get("orders", 0)
+        today = time.strftime("%Y-%m-%d", time.gmtime())
+        day_before, total_before = counters()
+        create_test_order("TEST_Rollup_User")
+        day_after, total_after = counters()
+        assert day_after >= day_before + 1
+        assert total_after >= total_before + 1
+        print(f"SUCCESS: Daily orders {day_before} -> {day_after}")
+    
+    def test_rebuild_requires_token(self):
+        """Test the rebuild is refused without the admin token"""
+        response = requests.post(f"{BASE_URL}/api/admin/reports/rebuild")
+        assert response.status_code in (403, 404)
+        print("SUCCESS: Rollup rebuild refused without admin token")
+    
+    def test_rebuild_reports(self):
+        """Test backfilling rollups runs as a background job"""
+        headers = admin_headers()
+        response = requests.post(f"{BASE_URL}/api/admin/reports/rebuild", headers=headers)
+        if response.status_code == 409:
+            pytest.skip("Another rebuild is running")
+        assert response.status_code == 202
+        run_id = response.json()["run_id"]
+        deadline = time.time() + 120
+        while True:
+            run = requests.get(f"{BASE_URL}/api/admin/reports/rebuild/{run_id}", headers=headers).json()
+            if run["state"] != "running" or time.time() > deadline:
+                break
+            time.sleep(1)
+        assert run["state"] == "done"
+        assert "orders_scanned" in run
+        print(f"SUCCESS: Rebuilt rollups from {run.get('orders_scanned')} orders")
+
+
+class TestOrderExport:
+    """Test streaming accounting export"""
+    
+    def test_export_csv(self):
+        """Test CSV export streams a header and excludes ID images"""
+        response = requests.get(f"{BASE_URL}/api/admin/orders/export", params={"format": "csv"}, headers=admin_headers(), stream=True)
+        assert response.status_code == 200
+        assert response.headers.get("content-type", "").startswith("text/csv")
+        body = response.text
+        assert body.splitlines()[0].startswith("id,created_at")
+        assert "data:image" not in body
+        print(f"SUCCESS: CSV export returned {len(body.splitlines()) - 1} orders")
+    
+    def test_export_ndjson_date_range(self):
+        """Test NDJSON export with a date range filter"""
+        response = requests.get(f"{BASE_URL}/api/admin/orders/export", params={"format": "ndjson", "start": "2020-01-01", "end": "2100-01-01"}, headers=admin_headers())
+        assert response.status_code == 200
+        for line in response.text.splitlines():
+            order = json.loads(line)
+            assert "id_image" not in order
+        print("SUCCESS: NDJSON export parsed without ID images")
+
+
+class TestOrderArchival:
+    """Test hot/cold order archival"""
+    
+    def test_run_archival(self):
+        """Test an on-demand archival pass"""
+        response = requests.post(f"{BASE_URL}/api/admin/orders/archive/run", headers=admin_headers())
+        assert response.status_code == 200
+        data = response.json()
+        assert data.get("ok") == True
+        assert "orders_archived" in data
+        assert "id_images_purged" in data
+        print(f"SUCCESS: Archived {data.get('orders_archived')} orders")
+    
+    def test_archive_lookup_missing_order(self):
+        """Test archive lookup returns 404 for unknown orders"""
+        response = requests.get(f"{BASE_URL}/api/admin/orders/archive/does-not-exist")
+        assert response.status_code == 404
+        print("SUCCESS: Unknown archived order returns 404")
+
+
+class TestSquarePaymentIdempotency:
+    """Test payment dedup on /api/payments/square"""
+    
+    def test_concurrent_payments_unknown_order(self):
+        """Test concurrent requests for one order all resolve to the same result"""
+        from concurrent.futures import ThreadPoolExecutor
+        body = {"source_id": "cnon:card-nonce-ok", "amount": 100, "order_id": "TEST_missing_order"}
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            responses = list(pool.map(lambda _: requests.post(f"{BASE_URL}/api/payments/square", json=body), range(4)))
+        assert all(r.status_code == 404 for r in responses)
+        print("SUCCESS: Concurrent payments for unknown order coalesced to 404")
+    
+    def test_same_order_paid_twice_charges_once(self):
+        """Test a double submit with a fresh card nonce each time yields one Square payment"""
+        order_id = create_test_order()
+        first = requests.post(f"{BASE_URL}/api/payments/square", json={"source_id": "cnon:card-nonce-ok", "amount": 100, "order_id": order_id})
+        if first.status_code != 200:
+            pytest.skip(f"Square sandbox not available ({first.status_code})")
+        second = requests.post(f"{BASE_URL}/api/payments/square", json={"source_id": "cnon:card-nonce-ok", "amount": 100, "order_id": order_id})
+        assert second.status_code == 200
+        assert second.json()["payment_id"] == first.json()["payment_id"]
+        print(f"SUCCESS: Order {order_id} charged once ({first.json()['payment_id']})")
+
+
+class TestWaitlist:
+    """Test waitlist signup endpoint"""
+    
+    def test_waitlist_signup(self):
+        """Test a new signup is queued and a repeat is recognised"""
+        email = f"test_waitlist_{uuid.uuid4().hex[:10]}@example.com"
+        response = requests.post(f"{BASE_URL}/api/waitlist", json={"email": email})
+        assert response.status_code == 200
+        assert response.json().get("status") == "queued"
+        time.sleep(1.5)  # allow the buffered insert_many to flush
+        repeat = requests.post(f"{BASE_URL}/api/waitlist", json={"email": email.upper()})
+        assert repeat.status_code == 200
+        assert repeat.json().get("status") == "already_registered"
+        print(f"SUCCESS: Waitlist signup deduplicated for {email}")
+    
+    def test_waitlist_invalid_email(self):
+        """Test invalid emails are rejected"""
+        response = requests.post(f"{BASE_URL}/api/waitlist", json={"email": "not-an-email"})
+        assert response.status_code == 422
+        print("SUCCESS: Invalid waitlist email rejected")
+
+
+class TestProfilingEndpoints:
+    """Test on-demand profiling endpoints are admin-only"""
+    
+    def test_cpu_profile_requires_token(self):
+        """Test CPU profiling is refused without the admin token"""
+        response = requests.get(f"{BASE_URL}/api/admin/profile/cpu", params={"seconds": 1})
+        assert response.status_code in (403, 404)
+        print("SUCCESS: CPU profiling refused without admin token")
+    
+    def test_memory_snapshot_with_token(self):
+        """Test tracemalloc snapshots when an admin token is configured"""
+        token = os.environ.get("ADMIN_TOKEN")
+        if not token:
+            pytest.skip("ADMIN_TOKEN not set")
+        headers = {"X-Admin-Token": token}
+        assert requests.post(f"{BASE_URL}/api/admin/profile/memory/start", headers=headers).status_code == 200
+        try:
+            first = requests.post(f"{BASE_URL}/api/admin/profile/memory/snapshot", headers=headers).json()
+            second = requests.post(f"{BASE_URL}/api/admin/profile/memory/snapshot", headers=headers).json()
+            diff = requests.get(f"{BASE_URL}/api/admin/profile/memory/diff", headers=headers,
+                                params={"base": first["snapshot_id"], "target": second["snapshot_id"]})
+            assert diff.status_code == 200
+            assert isinstance(diff.json().get("top"), list)
+        finally:
+            requests.post(f"{BASE_URL}/api/admin/profile/memory/stop", headers=headers)
+        print("SUCCESS: Memory snapshot diff returned")
+
+
+class TestCatalogImport:
+    """Test streaming bulk catalog import"""
+    
+    def test_import_csv_with_row_errors(self):
+        """Test CSV import upserts valid rows and reports invalid ones"""
+        body = "name,price,category,sku\nTEST_Import Grinder,9.99,Accessory,TEST-SKU-1\nTEST_Import Bad Row,not-a-price,Accessory,\n"
+        response = requests.post(f"{BASE_URL}/api/admin/products/import", params={"format": "csv"},
+                                 data=body.encode(), headers={"Content-Type": "text/csv", **admin_headers()})
+        assert response.status_code == 200
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        summary = lines[-1]
+        assert summary.get("done") == True
+        assert summary.get("rows") == 2
+        assert summary.get("valid") == 1
+        assert summary.get("error_count") == 1
+        assert summary["errors"][0]["line"] == 3
+        print(f"SUCCESS: Imported {summary.get('valid')} rows, {summary.get('error_count')} rejected")
+
+
+class TestRequestTracing:
+    """Test per-request trace ids"""
+    
+    def test_trace_id_header(self):
+        """Test every response carries a trace id"""
+        response = requests.get(f"{BASE_URL}/api/products")
+        assert response.status_code == 200
+        trace_id = response.headers.get("X-Trace-Id", "")
+        assert len(trace_id) == 32
+        print(f"SUCCESS: Got trace id {trace_id}")
+    
+    def test_traceparent_continued(self):
+        """Test an incoming W3C traceparent keeps its trace id"""
+        trace_id = uuid.uuid4().hex
+        response = requests.get(f"{BASE_URL}/api/health", headers={"traceparent": f"00-{trace_id}-{uuid.uuid4().hex[:16]}-01"})
+        assert response.headers.get("X-Trace-Id") == trace_id
+        print("SUCCESS: traceparent trace id propagated")
+
+
+class TestLoggingStats:
+    """Test logging queue and access-log sampling counters"""
+    
+    def test_logging_stats(self):
+        """Test drop and sampling counters are exposed"""
+        requests.get(f"{BASE_URL}/api/health")
+        response = requests.get(f"{BASE_URL}/api/admin/logging")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["queue_size"] > 0
+        assert isinstance(data["dropped"], dict)
+        assert data["access_sampling"]["/api/health"] == 0
+        print(f"SUCCESS: {data['access_logged']} access lines logged, {data['access_sampled_out']} sampled out")
 
 
 if __name__ == "__main__":
@@ -136,11 +136,15 @@ const AgeGate = ({ onPass }) => {
   );
 };
 
+// Set by the backend when it serves the production build with the catalog inlined
+const INITIAL_PRODUCTS = typeof window !== 'undefined' ? window.__INITIAL_PRODUCTS__ : undefined;
+
 function useProducts() {
-  const [items, setItems] = useState([]);
-  const [loading, setLoading] = useState(true);
+  const [items, setItems] = useState(INITIAL_PRODUCTS || []);
+  const [loading, setLoading] = useState(!INITIAL_PRODUCTS);
   const [error, setError] = useState(null);
   useEffect(()=>{
+    if (INITIAL_PRODUCTS) return;
     (async ()=>{
       try {
         await axios.post(`${API}/seed`);
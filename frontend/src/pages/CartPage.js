@@ -1,4 +1,4 @@
-import React, { useMemo, useState, useRef } from "react";
+import React, { useEffect, useMemo, useState, useRef } from "react";
 import axios from "axios";
 import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
@@ -22,6 +22,7 @@ export default function CartPage({ cart, setCart }){
   const [state, setState] = useState("TX");
   const [zip, setZip] = useState("");
   const [quote, setQuote] = useState(null);
+  const [pricing, setPricing] = useState(null);
   const [loading, setLoading] = useState(false);
   const [orderId, setOrderId] = useState(null);
   const [showPayment, setShowPayment] = useState(false);
@@ -34,15 +35,19 @@ export default function CartPage({ cart, setCart }){
   const [uploadingId, setUploadingId] = useState(false);
   const fileInputRef = useRef(null);
 
-  const subtotal = useMemo(()=> cart.reduce((s,i)=> s + i.price * i.qty, 0), [cart]);
+  const cartSubtotal = useMemo(()=> cart.reduce((s,i)=> s + i.price * i.qty, 0), [cart]);
+  const subtotal = pricing?.subtotal ?? cartSubtotal;
+
+  // Server pricing is for a specific cart; any change needs a fresh quote
+  useEffect(()=>{ setPricing(null); setQuote(null); }, [cart]);
 
   const handleIdUpload = async (e) => {
     const file = e.target.files[0];
     if (!file) return;
 
     // Check file type
-    if (!file.type.startsWith('image/')) {
-      toast.error("Please upload an image file");
+    if (!['image/jpeg', 'image/png', 'image/webp'].includes(file.type)) {
+      toast.error("Please upload a JPG, PNG or WebP image");
       return;
     }
 
@@ -54,23 +59,27 @@ export default function CartPage({ cart, setCart }){
 
     setUploadingId(true);
 
-    // Create preview
-    const reader = new FileReader();
-    reader.onloadend = () => {
-      setIdPreview(reader.result);
-      setIdImage(reader.result); // Base64 encoded image
+    // The server downscales the photo and hands back a reference for the order
+    try {
+      const form = new FormData();
+      form.append('file', file);
+      const { data } = await axios.post(`${API}/uploads/id`, form);
+      setIdPreview(URL.createObjectURL(file));
+      setIdImage(data.upload_id);
       setIdVerified(true);
-      setUploadingId(false);
       toast.success("ID uploaded successfully!");
-    };
-    reader.onerror = () => {
-      toast.error("Failed to read file");
+    } catch (err) {
+      toast.error(err?.response?.data?.detail || "Failed to upload ID");
+      if (fileInputRef.current) {
+        fileInputRef.current.value = '';
+      }
+    } finally {
       setUploadingId(false);
-    };
-    reader.readAsDataURL(file);
+    }
   };
 
   const removeId = () => {
+    if (idPreview) URL.revokeObjectURL(idPreview);
     setIdImage(null);
     setIdPreview(null);
     setIdVerified(false);
@@ -79,15 +88,21 @@ export default function CartPage({ cart, setCart }){
     }
   };
 
+  // One request returns server-side prices for the whole cart plus the delivery quote
   const getQuote = async ()=>{
-    if(!zip || !subtotal) return;
-    const { data } = await axios.post(`${API}/delivery/quote`, { zip, subtotal });
-    setQuote(data);
+    if(!zip || !cart.length) return;
+    const items = cart.map(c=> ({ product_id: c.id, quantity: c.qty, variant: c.selectedVariant?.name || null }));
+    const { data } = await axios.post(`${API}/cart/price`, { items, zip });
+    setPricing(data);
+    setQuote(data.quote);
+    if (data.errors?.length) {
+      toast.error(data.errors[0].error);
+    }
   };
 
   const createOrder = async ()=>{
     if (!cart.length) return;
-    if (!quote?.allowed) return;
+    if (!quote?.allowed || pricing?.errors?.length) return;
     if (!name || !dob || !phone || !address1 || !city || !zip) {
       toast.error("Please fill in all delivery details");
       return;
@@ -109,7 +124,7 @@ export default function CartPage({ cart, setCart }){
       const { data } = await axios.post(`${API}/orders/delivery`, { 
         items, 
         address,
-        id_image: idImage // Include the ID image
+        id_upload: idImage // Reference to the uploaded ID image
       });
       setOrderId(data.order_id);
       setOrderTotal(data.total);
@@ -247,7 +262,7 @@ export default function CartPage({ cart, setCart }){
                             <Camera className="w-8 h-8 text-emerald-400" />
                           </div>
                           <p className="text-emerald-400 font-medium">Tap to upload or take photo of ID</p>
-                          <p className="text-zinc-500 text-xs mt-1">Accepted: JPG, PNG, HEIC (max 10MB)</p>
+                          <p className="text-zinc-500 text-xs mt-1">Accepted: JPG, PNG, WebP (max 10MB)</p>
                         </>
                       )}
                     </div>
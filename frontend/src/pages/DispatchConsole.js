@@ -84,21 +84,25 @@ export default function DispatchConsole() {
     navigate("/");
   };
 
+  const applyOrders = (nextOrders) => {
+    setOrders(nextOrders);
+    
+    // Calculate stats
+    const newStats = { pending: 0, confirmed: 0, dispatched: 0, delivered: 0, cancelled: 0, total: nextOrders.length };
+    nextOrders.forEach(order => {
+      let status = order.status || "pending";
+      // Normalize pending_dispatch to pending for stats
+      if (status === "pending_dispatch") status = "pending";
+      if (newStats[status] !== undefined) newStats[status]++;
+    });
+    setStats(newStats);
+  };
+
   const fetchOrders = async () => {
     setLoading(true);
     try {
       const { data } = await axios.get(`${API}/admin/orders`);
-      setOrders(data.orders || []);
-      
-      // Calculate stats
-      const newStats = { pending: 0, confirmed: 0, dispatched: 0, delivered: 0, cancelled: 0, total: data.orders?.length || 0 };
-      (data.orders || []).forEach(order => {
-        let status = order.status || "pending";
-        // Normalize pending_dispatch to pending for stats
-        if (status === "pending_dispatch") status = "pending";
-        if (newStats[status] !== undefined) newStats[status]++;
-      });
-      setStats(newStats);
+      applyOrders(data.orders || []);
     } catch (e) {
       console.error("Failed to fetch orders:", e);
     } finally {
@@ -106,15 +110,24 @@ export default function DispatchConsole() {
     }
   };
 
-  const updateOrderStatus = async (orderId, newStatus) => {
+  // One request for any number of orders; the response is applied locally instead of re-fetching
+  const updateOrderStatuses = async (orderIds, newStatus) => {
+    if (!orderIds.length) return;
     try {
-      await axios.patch(`${API}/admin/orders/${orderId}/status`, { status: newStatus });
-      fetchOrders(); // Refresh orders
+      const { data } = await axios.post(`${API}/admin/orders/status/bulk`, {
+        updates: orderIds.map(order_id => ({ order_id, status: newStatus }))
+      });
+      const done = new Set(data.results.filter(r => r.ok).map(r => r.order_id));
+      applyOrders(orders.map(o => done.has(o.id) ? { ...o, status: newStatus, updated_at: data.updated_at } : o));
     } catch (e) {
-      console.error("Failed to update order:", e);
+      console.error("Failed to update orders:", e);
     }
   };
 
+  const updateOrderStatus = (orderId, newStatus) => updateOrderStatuses([orderId], newStatus);
+
+  const confirmedOrderIds = orders.filter(o => o.status === "confirmed").map(o => o.id);
+
   const getNextStatus = (currentStatus) => {
     const idx = STATUS_FLOW.indexOf(currentStatus);
     if (idx < STATUS_FLOW.length - 1) return STATUS_FLOW[idx + 1];
@@ -195,6 +208,16 @@ export default function DispatchConsole() {
             </div>
           </div>
           <div className="flex items-center gap-4">
+            <Button 
+              onClick={() => updateOrderStatuses(confirmedOrderIds, "dispatched")} 
+              disabled={!confirmedOrderIds.length}
+              variant="outline" 
+              className="border-purple-500/30 text-purple-400 hover:bg-purple-500/10"
+              data-testid="dispatch-all-btn"
+            >
+              <Truck className="w-4 h-4 mr-2" />
+              Dispatch All Confirmed ({confirmedOrderIds.length})
+            </Button>
             <Button 
               onClick={fetchOrders} 
               variant="outline" 
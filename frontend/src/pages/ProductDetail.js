@@ -28,19 +28,17 @@ export default function ProductDetail({ addToCart }) {
   useEffect(() => {
     const fetchProduct = async () => {
       try {
-        const { data } = await axios.get(`${API}/products/${productId}`);
+        // Related items are ranked server-side, so both requests can go out together
+        const [{ data }, related] = await Promise.all([
+          axios.get(`${API}/products/${productId}`),
+          axios.get(`${API}/products/${productId}/related`, { params: { limit: 4 } }).catch(() => ({ data: [] })),
+        ]);
         setProduct(data);
         // Auto-select first variant if available
         if (data.variants && data.variants.length > 0) {
           setSelectedVariant(data.variants[0]);
         }
-        
-        // Fetch related products from same category
-        const allProducts = await axios.get(`${API}/products`);
-        const related = allProducts.data
-          .filter(p => p.category === data.category && p.id !== data.id)
-          .slice(0, 4);
-        setRelatedProducts(related);
+        setRelatedProducts(related.data);
       } catch (e) {
         setError("Product not found");
       } finally {